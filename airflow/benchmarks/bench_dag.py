@@ -0,0 +1,279 @@
+"""Offline end-to-end benchmark of the dbt Cloud run metadata DAG.
+
+Every API the DAG talks to is served by fake_apis.FakeApiServer and Snowflake
+is replaced by fake_snowflake.FakeSnowflakeHook, so no network access or
+credentials are needed. The task callables of the DAG are called in
+dependency order, with results passed through a JSON round trip like XCom,
+for each requested number of runs. For every stage the benchmark reports:
+
+    wall time, peak traced memory, requests per API, events sent to the
+    Event API, events per second and the size of the XCom result
+
+    python airflow/benchmarks/bench_dag.py --runs 10 100 1000
+    python airflow/benchmarks/bench_dag.py --runs 100 --two-phase --json results.json
+
+Peak memory is measured with tracemalloc, which slows down the stages. Use
+--no-memory for wall times closer to a real deployment.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DAGS_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, '..', 'dags')
+DAG_FILE = os.path.join(DAGS_DIRECTORY, 'dbt_cloud_run_metadata', 'dag.py')
+sys.path.insert(0, DAGS_DIRECTORY)
+
+from fake_apis import FakeApiServer  # noqa: E402
+from fake_snowflake import FakeSnowflakeHook  # noqa: E402
+from synthetic import SyntheticAccount  # noqa: E402
+from nr_utils import telemetry  # noqa: E402
+
+APIS = ('admin', 'discovery', 'nerdgraph', 'events')
+
+
+def configure_airflow(home: str, server: FakeApiServer) -> None:
+    # Airflow reads these when it is first imported, so this runs before any airflow import
+    os.environ['AIRFLOW_HOME'] = home
+    os.environ['AIRFLOW__CORE__DAGS_FOLDER'] = DAGS_DIRECTORY
+    os.environ['AIRFLOW__CORE__LOAD_EXAMPLES'] = 'False'
+    os.environ.setdefault('AIRFLOW_VAR_NR_ACCOUNT_ID', '1')
+
+    from nr_utils.nr_utils import read_config
+    config = read_config(os.path.join(DAGS_DIRECTORY, 'dbt_cloud_run_metadata', 'dag_config.yml'))
+    # Every DAG in the dags list is served by the same fake APIs
+    connection_sets = [config['connections']] + [entry['connections'] for entry in config.get('dags') or []
+                                                 if entry.get('connections')]
+    hosts = {
+        'dbt_cloud_admin_api': server.url('admin'),
+        'dbt_cloud_discovery_api': server.url('discovery/graphql'),
+        'nr_insights_query': server.url('nerdgraph'),
+        'nr_insights_insert': server.url('events'),
+    }
+    for connections in connection_sets:
+        for name, host in hosts.items():
+            if name in connections:
+                connection = {'conn_type': 'http', 'host': host, 'password': 'benchmark'}
+                os.environ[f'AIRFLOW_CONN_{connections[name].upper()}'] = json.dumps(connection)
+
+
+def load_dag(dag_id: str = None):
+    from airflow.models import DagBag
+
+    dag_bag = DagBag(dag_folder=DAG_FILE, include_examples=False)
+    if dag_bag.import_errors:
+        raise RuntimeError(f'Could not load the DAG: {dag_bag.import_errors}')
+    if dag_id:
+        return dag_bag.dags[dag_id]
+    return next(iter(dag_bag.dags.values()))
+
+
+def patch_snowflake() -> None:
+    # nr_utils.snowflake imports the hook when it runs a query, so the provider module is patched
+    import airflow.providers.snowflake.hooks.snowflake
+    airflow.providers.snowflake.hooks.snowflake.SnowflakeHook = FakeSnowflakeHook
+
+
+class StageRecorder:
+    '''Calls task callables and records wall time, memory, requests and events for each one.'''
+
+    def __init__(self, dag, server: FakeApiServer, track_memory: bool = True, verbose: bool = False):
+        self.dag = dag
+        self.server = server
+        self.track_memory = track_memory
+        self.verbose = verbose
+        self.stages = []
+        self.task_id = None
+
+    def get_current_context(self) -> dict:
+        # Stands in for the Airflow context of the task being benchmarked
+        return {
+            'dag': self.dag,
+            'run_id': 'benchmark__2024-06-10T12:00:00+00:00',
+            'ti': SimpleNamespace(dag_id=self.dag.dag_id, task_id=self.task_id),
+        }
+
+    def run(self, name: str, function, *args, **kwargs):
+        self.task_id = name
+        self.server.reset_stats()
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        output = contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+        start = time.perf_counter()
+        with output:
+            result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1] - baseline if self.track_memory else None
+
+        # Task results go through XCom as JSON
+        serialized = json.dumps(result, default=str)
+        telemetry_events = self.server.events[telemetry.EVENT_TYPE]
+        events = sum(self.server.events.values()) - telemetry_events
+        stage = {
+            'stage': name,
+            'seconds': seconds,
+            'peak_mb': peak_bytes / 1024 / 1024 if peak_bytes is not None else None,
+            'events': events,
+            'telemetry_events': telemetry_events,
+            'events_per_second': events / seconds if seconds else 0,
+            'xcom_kb': len(serialized) / 1024,
+        }
+        for api in APIS:
+            stage[f'{api}_requests'] = self.server.stats[f'{api}_requests']
+        self.stages.append(stage)
+        return json.loads(serialized)
+
+
+def run_benchmark(dag, server: FakeApiServer, run_count: int, args, work_directory: str) -> list:
+    interval_end = datetime(2024, 6, 10, 13, 0, tzinfo=timezone.utc)
+    interval_start = interval_end - timedelta(hours=1)
+    account = SyntheticAccount(run_count, interval_start, interval_end,
+                               resource_count=args.resources, selected_fraction=args.selected,
+                               failing_run_fraction=args.failing, macro_count=args.macros)
+    server.load(account)
+    FakeSnowflakeHook.seed(sorted({node['name'] for manifest in account.manifests.values()
+                                   for node in manifest['nodes'].values() if node['resource_type'] == 'test'}))
+
+    # Every size starts with an empty ledger and manifest cache
+    dag_globals = dag.get_task('get_dbt_runs').python_callable.__globals__
+    # The DAG loads its config lazily and keeps it, so changes to the sections apply to every task
+    dag_config = dag_globals['get_dag_config'](dag.dag_id)
+
+    def config_section(name):
+        return dag_config.setdefault(name, {})
+
+    config_section('idempotency').update(
+        ledger_path=os.path.join(work_directory, f'ledger_{run_count}.sqlite'),
+        nrql_reconciliation=True,
+        max_runs=max(run_count, config_section('idempotency').get('max_runs', 200)))
+    config_section('manifest')['cache_dir'] = os.path.join(work_directory, f'manifest_cache_{run_count}')
+    config_section('catalog_cache')['path'] = os.path.join(work_directory, f'catalog_cache_{run_count}.json')
+    config_section('discovery')['two_phase'] = args.two_phase
+    config_section('normalized_events')['enabled'] = args.normalized
+    config_section('telemetry')['enabled'] = not args.no_telemetry
+
+    import pendulum
+    data_interval = {
+        'data_interval_start': pendulum.instance(interval_start),
+        'data_interval_end': pendulum.instance(interval_end),
+        'params': {'backfill_start': None, 'backfill_end': None},
+    }
+    if args.backfill:
+        data_interval['params'] = {
+            'backfill_start': (interval_start - timedelta(minutes=5)).isoformat(),
+            'backfill_end': (interval_end - timedelta(minutes=5)).isoformat(),
+        }
+
+    def task(task_id):
+        return dag.get_task(task_id).python_callable
+
+    recorder = StageRecorder(dag, server, track_memory=not args.no_memory, verbose=args.verbose)
+    dag_globals['get_current_context'] = recorder.get_current_context
+    runs = recorder.run('get_dbt_runs', task('get_dbt_runs'), **data_interval)
+    projects = recorder.run('get_dbt_projects', task('get_dbt_projects'))
+    environments = recorder.run('get_dbt_environments', task('get_dbt_environments'))
+    enriched_runs = recorder.run('enrich_runs', task('enrich_runs'), runs, projects, environments)
+    queries = recorder.run('get_nrql_queries', task('get_nrql_queries'), enriched_runs, **data_interval)
+    nr_run_ids = recorder.run('get_nr_run_ids', task('get_nr_run_ids'), queries)
+    runs_to_process = recorder.run(
+        'get_runs_to_process', task('get_runs_to_process'), enriched_runs,
+        nr_run_ids['nr_runs'], nr_run_ids['nr_resource_runs'], nr_run_ids['nr_failed_test_row_runs'])
+    recorder.run('process_runs', task('process_runs'), runs_to_process['runs_to_process'])
+    shards = recorder.run('shard_resource_runs', task('shard_resource_runs'),
+                          runs_to_process['resource_runs_to_process'])
+    # Mapped tasks run one after the other here. On a worker pool they run side by side
+    shard_failed_tests = recorder.run(
+        'process_resource_runs', lambda: [task('process_resource_runs')(shard) for shard in shards])
+    failed_tests = recorder.run('collect_failed_tests', task('collect_failed_tests'), shard_failed_tests)
+    recorder.run('process_failed_test_rows', task('process_failed_test_rows'),
+                 failed_tests, runs_to_process['failed_test_runs_to_process'])
+
+    for stage in recorder.stages:
+        stage['runs'] = run_count
+    return recorder.stages
+
+
+def print_results(run_count: int, stages: list) -> None:
+    header = (f'{"stage":<26}{"wall s":>9}{"peak MB":>9}{"admin":>7}{"disc":>6}{"nerd":>6}{"event":>7}'
+              f'{"events":>9}{"events/s":>10}{"xcom KB":>10}')
+    print(f'\n{run_count} runs')
+    print(header)
+    print('-' * len(header))
+    for stage in stages + [total(stages)]:
+        peak = f'{stage["peak_mb"]:9.1f}' if stage['peak_mb'] is not None else f'{"-":>9}'
+        print(f'{stage["stage"]:<26}{stage["seconds"]:9.3f}{peak}{stage["admin_requests"]:7d}'
+              f'{stage["discovery_requests"]:6d}{stage["nerdgraph_requests"]:6d}{stage["events_requests"]:7d}'
+              f'{stage["events"]:9d}{stage["events_per_second"]:10.0f}{stage["xcom_kb"]:10.1f}')
+
+
+def total(stages: list) -> dict:
+    seconds = sum(stage['seconds'] for stage in stages)
+    events = sum(stage['events'] for stage in stages)
+    telemetry_events = sum(stage['telemetry_events'] for stage in stages)
+    peaks = [stage['peak_mb'] for stage in stages if stage['peak_mb'] is not None]
+    result = {
+        'stage': 'total',
+        'seconds': seconds,
+        'peak_mb': max(peaks) if peaks else None,
+        'events': events,
+        'telemetry_events': telemetry_events,
+        'events_per_second': events / seconds if seconds else 0,
+        'xcom_kb': sum(stage['xcom_kb'] for stage in stages),
+    }
+    for api in APIS:
+        result[f'{api}_requests'] = sum(stage[f'{api}_requests'] for stage in stages)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, nargs='+', default=[10, 100, 1000], help='numbers of runs to benchmark')
+    parser.add_argument('--resources', type=int, default=200, help='manifest nodes per project')
+    parser.add_argument('--selected', type=float, default=0.25, help='fraction of the project each run builds')
+    parser.add_argument('--failing', type=float, default=0.05, help='fraction of runs with a failing test')
+    parser.add_argument('--macros', type=int, default=200, help='macros per manifest')
+    parser.add_argument('--two-phase', action='store_true', help='enable two phase discovery')
+    parser.add_argument('--normalized', action='store_true', help='send normalized resource run events')
+    parser.add_argument('--backfill', action='store_true', help='trigger the DAG as a backfill')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory')
+    parser.add_argument('--no-telemetry', action='store_true', help='do not send dbt_integration_perf events')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the tasks')
+    parser.add_argument('--dag-id', help='DAG to benchmark when the file defines several')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    with tempfile.TemporaryDirectory(prefix='nr_dbt_benchmark_') as work_directory:
+        server = FakeApiServer().start()
+        configure_airflow(os.path.join(work_directory, 'airflow'), server)
+        dag = load_dag(args.dag_id)
+        patch_snowflake()
+        if not args.no_memory:
+            tracemalloc.start()
+
+        results = []
+        try:
+            for run_count in args.runs:
+                stages = run_benchmark(dag, server, run_count, args, work_directory)
+                print_results(run_count, stages)
+                results += stages
+        finally:
+            server.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f_handle:
+            json.dump(results, f_handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
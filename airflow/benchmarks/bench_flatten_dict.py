@@ -0,0 +1,89 @@
+"""Micro-benchmark for nr_utils.flatten_dict.
+
+Compares the compiled flattener with the previous loop based implementation on
+records shaped like dbt_resource_run events.
+
+    python airflow/benchmarks/bench_flatten_dict.py --records 50000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+
+from nr_utils.nr_utils import flatten_dict, flatten_records  # noqa: E402
+
+
+def flatten_dict_loop(input_dict: dict, prefix: str) -> dict:
+    # The implementation flatten_dict had before it was compiled per record shape
+    max_string_length = 4096
+    flat_dict = {}
+    for key, value in input_dict.items():
+        if key.endswith('_id') or key == 'id':
+            flat_dict[prefix + key] = str(value)
+        elif isinstance(value, int) or isinstance(value, float):
+            flat_dict[prefix + key] = value
+        else:
+            flat_dict[prefix + key] = str(value)[0:max_string_length]
+    return flat_dict
+
+
+def make_resource_run(index: int) -> dict:
+    record = {
+        'name': f'model_{index}',
+        'unique_id': f'model.project.model_{index}',
+        'status': 'success' if index % 10 else 'error',
+        'execution_time': index * 0.01,
+        'description': 'A model description. ' * 5,
+        'meta': {'owner': 'data-engineering', 'tier': index % 3},
+        'tags': ['daily', 'finance'],
+        'error': None,
+        'skip': False,
+        'compiled_sql': 'select id, amount from analytics.orders where amount > 0 ' * 40,
+        'raw_code': 'select id, amount from {{ ref("orders") }} where amount > 0 ' * 20,
+        'resource_type': 'model',
+        'test_parameters': {'column_name': 'id', 'model': "{{ get_where_subquery(ref('orders')) }}"},
+        'alert_failed_test_rows': False,
+        'failed_test_row_limit': 100,
+        'team': 'Data Engineering',
+        'run_id': str(1000 + index // 100),
+        'job_id': '42',
+        'run_status': 10,
+        'run_created_at': '2024-06-10 12:00:00.000000+00:00',
+        'eventType': 'dbt_resource_run',
+    }
+    # Enriched runs carry the rest of the run, job, project and environment attributes
+    for field in range(40):
+        record[f'run_attribute_{field}'] = f'value {field}' if field % 2 else field
+    return record
+
+
+def measure(name: str, function, records: list, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(records)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<28} {best:8.3f}s  {len(records) / best:12,.0f} records/s')
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    records = [make_resource_run(index) for index in range(args.records)]
+    assert [flatten_dict_loop(record, '') for record in records[:100]] == flatten_records(records[:100])
+
+    baseline = measure('loop flatten_dict', lambda rs: [flatten_dict_loop(r, '') for r in rs], records, args.repeat)
+    compiled = measure('compiled flatten_dict', lambda rs: [flatten_dict(r, '') for r in rs], records, args.repeat)
+    batch = measure('flatten_records', lambda rs: flatten_records(rs, ''), records, args.repeat)
+    print(f'Speedup: flatten_dict {baseline / compiled:.2f}x, flatten_records {baseline / batch:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
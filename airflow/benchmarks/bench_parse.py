@@ -0,0 +1,122 @@
+"""Parse time benchmark of the dbt Cloud run metadata DAG file.
+
+The scheduler parses DAG files over and over, so the work done at import
+time is paid constantly. Every repetition runs in a fresh interpreter that
+has already imported Airflow, like a DAG file processor, and then parses the
+DAG file with DagBag.process_file. The benchmark reports:
+
+    parse time (median and max), modules imported by the DAG file, provider
+    and client modules among them and Airflow Variable lookups
+
+    python airflow/benchmarks/bench_parse.py --repeat 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DAGS_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, '..', 'dags')
+DAG_FILE = os.path.join(DAGS_DIRECTORY, 'dbt_cloud_run_metadata', 'dag.py')
+
+# Modules that should only be imported when a task runs
+HEAVY_MODULES = (
+    'airflow.providers.http.hooks.http',
+    'airflow.providers.snowflake.hooks.snowflake',
+    'snowflake.connector',
+    'aiohttp',
+)
+
+
+def parse_once(dag_file: str) -> dict:
+    # Runs in the child interpreter
+    from airflow.models import DagBag, Variable
+
+    variable_lookups = []
+    variable_get = Variable.get
+
+    def counting_get(*args, **kwargs):
+        variable_lookups.append(args[0] if args else kwargs.get('key'))
+        return variable_get(*args, **kwargs)
+
+    Variable.get = counting_get
+    modules_before = set(sys.modules)
+    dag_bag = DagBag(dag_folder=os.devnull, include_examples=False, read_dags_from_db=False)
+    start = time.perf_counter()
+    dags = dag_bag.process_file(dag_file, only_if_updated=False)
+    seconds = time.perf_counter() - start
+    new_modules = set(sys.modules) - modules_before
+    return {
+        'seconds': seconds,
+        'dags': len(dags),
+        'errors': {path: str(error)[:200] for path, error in dag_bag.import_errors.items()},
+        'modules': len(new_modules),
+        'heavy_modules': sorted(module for module in HEAVY_MODULES if module in new_modules),
+        'variable_lookups': variable_lookups,
+    }
+
+
+def run_child(dag_file: str, home: str) -> dict:
+    environment = dict(os.environ)
+    environment.update({
+        'AIRFLOW_HOME': home,
+        'AIRFLOW__CORE__LOAD_EXAMPLES': 'False',
+        'AIRFLOW__CORE__DAGS_FOLDER': os.path.dirname(os.path.dirname(os.path.abspath(dag_file))),
+        'PYTHONPATH': os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(dag_file))),
+                                                     environment.get('PYTHONPATH')])),
+    })
+    environment.setdefault('AIRFLOW_VAR_NR_ACCOUNT_ID', '1')
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', dag_file],
+        env=environment, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='number of fresh interpreters to parse in')
+    parser.add_argument('--dag-file', default=DAG_FILE, help='DAG file to parse')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    if args.child:
+        # Airflow is imported before the clock starts, the same as in a DAG file processor
+        import airflow.models  # noqa: F401
+        print(json.dumps(parse_once(args.child)))
+        return
+
+    with tempfile.TemporaryDirectory(prefix='nr_dbt_parse_') as home:
+        results = [run_child(args.dag_file, home) for _ in range(args.repeat)]
+
+    seconds = [result['seconds'] for result in results]
+    last = results[-1]
+    summary = {
+        'dag_file': args.dag_file,
+        'repeat': args.repeat,
+        'median_ms': statistics.median(seconds) * 1000,
+        'max_ms': max(seconds) * 1000,
+        'dags': last['dags'],
+        'errors': last['errors'],
+        'modules': last['modules'],
+        'heavy_modules': last['heavy_modules'],
+        'variable_lookups': last['variable_lookups'],
+    }
+    print(f"parse time      median {summary['median_ms']:.1f} ms, max {summary['max_ms']:.1f} ms over {args.repeat} runs")
+    print(f"dags            {summary['dags']}")
+    print(f"modules         {summary['modules']} imported by the DAG file")
+    print(f"heavy modules   {', '.join(summary['heavy_modules']) or 'none'}")
+    print(f"variables       {', '.join(map(str, summary['variable_lookups'])) or 'none'}")
+    for path, error in summary['errors'].items():
+        print(f'import error    {path}: {error}')
+    if args.json:
+        with open(args.json, 'w') as f_handle:
+            json.dump(summary, f_handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
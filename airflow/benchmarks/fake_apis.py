@@ -0,0 +1,227 @@
+"""Local stand-ins for the dbt Cloud admin and discovery APIs, NerdGraph and the New Relic Event API.
+
+One threaded HTTP server serves every API under its own path prefix:
+
+    /admin       dbt Cloud admin API v2 (runs, projects, environments by page or id, manifest.json)
+    /discovery   dbt Cloud discovery API (GraphQL)
+    /nerdgraph   New Relic NerdGraph (GraphQL)
+    /events      New Relic Event API
+
+Responses are generated from a SyntheticAccount and every request is counted
+per API so the benchmarks can report request counts and bytes transferred.
+"""
+import gzip
+import json
+import re
+import threading
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from synthetic import SyntheticAccount, dbt_time
+
+
+# Page size of the admin API
+ADMIN_PAGE_SIZE = 100
+
+_RESOURCE_TYPES = {
+    'models': 'model', 'tests': 'test', 'seeds': 'seed', 'snapshots': 'snapshot',
+    'model': 'model', 'test': 'test', 'seed': 'seed', 'snapshot': 'snapshot',
+}
+# alias: resourceField(arguments) { selection }
+_GRAPHQL_FIELD_PATTERN = re.compile(r'(\w+)\s*:\s*(models|tests|seeds|snapshots|model|test|seed|snapshot)\s*\(([^)]*)\)\s*\{([^}]*)\}')
+_GRAPHQL_ARGUMENT_PATTERN = re.compile(r'(\w+)\s*:\s*\$(\w+)')
+_GRAPHQL_SELECTION_PATTERN = re.compile(r'(\w+)(?:\s*:\s*(\w+))?')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, value, status: int = 200) -> None:
+        self._send_bytes(json.dumps(value, separators=(',', ':')).encode('utf-8'), status)
+
+    def _send_bytes(self, body: bytes, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.fake.count(self.path, bytes_out=len(body))
+
+    def _read_body(self) -> bytes:
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.fake.count(self.path, requests=1, bytes_in=len(body))
+        return body
+
+    def do_GET(self):
+        self.server.fake.count(self.path, requests=1)
+        url = urlparse(self.path)
+        if not url.path.startswith('/admin/'):
+            return self._send_json({'error': 'not found'}, 404)
+        return self.server.fake.admin_get(self, url.path[len('/admin'):], parse_qs(url.query))
+
+    def do_POST(self):
+        body = self._read_body()
+        path = urlparse(self.path).path
+        if path.startswith('/discovery'):
+            return self._send_json(self.server.fake.discovery(json.loads(body)))
+        if path.startswith('/nerdgraph'):
+            return self._send_json(self.server.fake.nerdgraph(json.loads(body)))
+        if path.startswith('/events'):
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            self.server.fake.receive_events(json.loads(body))
+            return self._send_json({'success': True, 'uuid': '00000000-0000-0000-0000-000000000000'})
+        return self._send_json({'error': 'not found'}, 404)
+
+
+class FakeApiServer:
+    '''Threaded HTTP server that answers for every API the DAG calls.'''
+
+    def __init__(self, account: SyntheticAccount = None):
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 256
+        self._server.fake = self
+        self._thread = None
+        self.stats = Counter()
+        self.events = Counter()
+        self.load(account)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def url(self, prefix: str) -> str:
+        return f'http://127.0.0.1:{self.port}/{prefix}'
+
+    def start(self) -> 'FakeApiServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def load(self, account: SyntheticAccount) -> None:
+        # Serves a new account. Manifests are serialized once since every run of a project shares one
+        self.account = account
+        self._manifests = {}
+        if account:
+            self._manifests = {project_id: json.dumps(manifest).encode('utf-8')
+                               for project_id, manifest in account.manifests.items()}
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.stats = Counter()
+            self.events = Counter()
+
+    def count(self, path: str, requests: int = 0, bytes_in: int = 0, bytes_out: int = 0) -> None:
+        api = path.strip('/').split('/', 1)[0]
+        with self._lock:
+            self.stats[f'{api}_requests'] += requests
+            self.stats[f'{api}_bytes_in'] += bytes_in
+            self.stats[f'{api}_bytes_out'] += bytes_out
+
+    # dbt Cloud admin API
+
+    def admin_get(self, handler: _Handler, path: str, query: dict):
+        if path.startswith('/runs/') and path.endswith('/artifacts/manifest.json'):
+            run = self.account.get_run(int(path.split('/')[2]))
+            return handler._send_bytes(self._manifests[run['project_id']])
+        if path == '/runs/':
+            items = self.account.runs
+            if 'finished_at__range' in query:
+                start, end = (datetime.fromisoformat(value) for value in json.loads(query['finished_at__range'][0]))
+                start, end = dbt_time(start), dbt_time(end)
+                items = [run for run in items if start <= run['finished_at'] <= end]
+            if query.get('order_by') == ['-finished_at']:
+                items = sorted(items, key=lambda run: run['finished_at'], reverse=True)
+        elif path == '/projects/':
+            items = list(self.account.projects.values())
+        elif path == '/environments/':
+            items = list(self.account.environments.values())
+        elif re.fullmatch(r'/(projects|environments)/\d+/', path):
+            listing, item_id = path.strip('/').split('/')
+            item = getattr(self.account, listing).get(int(item_id))
+            if item is None:
+                return handler._send_json({'status': {'code': 404}, 'data': None}, 404)
+            return handler._send_json({'status': {'code': 200, 'is_success': True}, 'data': item})
+        else:
+            return handler._send_json({'status': {'code': 404}, 'data': None}, 404)
+
+        offset = int(query.get('offset', ['0'])[0])
+        limit = min(int(query.get('limit', [ADMIN_PAGE_SIZE])[0]), ADMIN_PAGE_SIZE)
+        page = items[offset:offset + limit]
+        return handler._send_json({
+            'status': {'code': 200, 'is_success': True},
+            'data': page,
+            'extra': {
+                'filters': {'offset': offset, 'limit': limit},
+                'pagination': {'count': len(page), 'total_count': len(items)},
+            },
+        })
+
+    # dbt Cloud discovery API
+
+    def discovery(self, request: dict) -> dict:
+        variables = request.get('variables') or {}
+        data = {}
+        for alias, field, arguments, selection in _GRAPHQL_FIELD_PATTERN.findall(request['query']):
+            arguments = {name: variables.get(variable) for name, variable in _GRAPHQL_ARGUMENT_PATTERN.findall(arguments)}
+            resource_type = _RESOURCE_TYPES[field]
+            statuses = self.account.resource_statuses(int(arguments['runId']))[resource_type]
+            if 'uniqueId' in arguments:
+                matches = [status for status in statuses if status['unique_id'] == arguments['uniqueId']]
+                data[alias] = self._discovery_resource(matches[0], selection) if matches else None
+            else:
+                data[alias] = [self._discovery_resource(status, selection) for status in statuses]
+        return {'data': data}
+
+    @staticmethod
+    def _discovery_resource(status: dict, selection: str) -> dict:
+        resource = {}
+        for output_name, field_name in _GRAPHQL_SELECTION_PATTERN.findall(selection):
+            field_name = field_name or output_name
+            if field_name in ('uniqueId', 'unique_id'):
+                value = status['unique_id']
+            elif field_name in ('name', 'status', 'resourceType'):
+                value = status['name' if field_name == 'name' else 'status' if field_name == 'status' else 'resource_type']
+            elif field_name in ('rawSql', 'rawCode', 'compiledSql', 'compiledCode'):
+                value = status['compiled_sql']
+            elif field_name == 'executionTime':
+                value = 1.25
+            elif field_name in ('compileStartedAt', 'compileCompletedAt', 'executeStartedAt', 'executeCompletedAt'):
+                value = '2024-06-10T12:00:00.000Z'
+            elif field_name in ('fail', 'warn', 'skip'):
+                value = field_name == 'fail' and status['status'] == 'fail'
+            elif field_name == 'error':
+                value = 'Database Error' if status['status'] == 'error' else None
+            elif field_name in ('meta',):
+                value = {'owner': 'analytics'}
+            elif field_name == 'tags':
+                value = ['daily']
+            elif field_name == 'description':
+                value = f'Description of {status["name"]}'
+            else:
+                value = f'{field_name} value'
+            resource[output_name] = value
+        return resource
+
+    # New Relic
+
+    def nerdgraph(self, request: dict) -> dict:
+        # Nothing was sent before, so every run id query comes back empty
+        aliases = [name for name in (request.get('variables') or {}) if name != 'accountId']
+        return {'data': {'actor': {'account': {alias: {'results': [{'members': []}]} for alias in aliases}}}}
+
+    def receive_events(self, events: list) -> None:
+        with self._lock:
+            for event in events:
+                self.events[event.get('eventType', 'unknown')] += 1
@@ -0,0 +1,135 @@
+"""SQLite backed stand-in for SnowflakeHook.
+
+The connection implements the asynchronous query calls get_failed_test_rows
+uses (execute_async, get_query_status_throw_if_error, is_still_running and
+get_results_from_sfqid). Queries run against an in-memory SQLite database
+seeded with failing rows and report as running for query_seconds. Results
+can be read with fetch_arrow_batches when pyarrow is installed, and
+"alter session set STATEMENT_TIMEOUT_IN_SECONDS" is honoured.
+"""
+import itertools
+import re
+import sqlite3
+import threading
+import time
+
+from synthetic import FAILED_ROWS_TABLE
+
+
+_ALTER_SESSION_PATTERN = re.compile(r'^\s*alter\s+session\s+set\s+(\w+)\s*=\s*(\S+)\s*$', re.IGNORECASE)
+# Rows in each Arrow batch, like the result chunks Snowflake returns
+ARROW_BATCH_ROWS = 1000
+
+
+class FakeQueryStatus:
+    def __init__(self, running: bool):
+        self.running = running
+
+
+class FakeSnowflakeCursor:
+    def __init__(self, connection: 'FakeSnowflakeConnection'):
+        self.connection = connection
+        self.description = None
+        self.sfqid = None
+        self._rows = iter(())
+
+    def execute(self, sql: str, params=None):
+        self.connection.queries += 1
+        match = _ALTER_SESSION_PATTERN.match(sql)
+        if match:
+            self.connection.session_parameters[match.group(1).upper()] = match.group(2)
+            return self
+        cursor = self.connection.db.execute(sql, params or ())
+        self.description = cursor.description
+        self._rows = iter(cursor.fetchall())
+        return self
+
+    def execute_async(self, sql: str, params=None):
+        self.connection.queries += 1
+        self.sfqid = self.connection.submit(sql)
+        return {'queryId': self.sfqid}
+
+    def get_results_from_sfqid(self, query_id: str) -> None:
+        cursor = self.connection.db.execute(self.connection.submitted[query_id][0])
+        self.description = cursor.description
+        self._rows = iter(cursor.fetchall())
+
+    def fetchmany(self, size: int) -> list:
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self) -> list:
+        return list(self._rows)
+
+    def fetch_arrow_batches(self):
+        import pyarrow
+
+        names = [column[0] for column in self.description]
+        while True:
+            rows = self.fetchmany(ARROW_BATCH_ROWS)
+            if not rows:
+                return
+            yield pyarrow.table({name: list(values) for name, values in zip(names, zip(*rows))})
+
+    def close(self) -> None:
+        pass
+
+
+class FakeSnowflakeConnection:
+    def __init__(self, db: sqlite3.Connection, query_seconds: float):
+        self.db = db
+        self.query_seconds = query_seconds
+        self.submitted = {}
+        self.session_parameters = {}
+        self.queries = 0
+        self._ids = itertools.count()
+
+    def submit(self, sql: str) -> str:
+        query_id = f'01b2c3d4-0000-{next(self._ids):012d}'
+        self.submitted[query_id] = (sql, time.monotonic())
+        return query_id
+
+    def cursor(self) -> FakeSnowflakeCursor:
+        return FakeSnowflakeCursor(self)
+
+    def get_query_status_throw_if_error(self, query_id: str) -> FakeQueryStatus:
+        sql, submitted_at = self.submitted[query_id]
+        # Compile the query up front so SQL errors surface like Snowflake reports them
+        self.db.execute(f'explain {sql}')
+        timeout = float(self.session_parameters.get('STATEMENT_TIMEOUT_IN_SECONDS', 0))
+        if timeout and self.query_seconds > timeout:
+            raise RuntimeError(f'Statement reached its statement or warehouse timeout of {timeout:g} second(s) '
+                               f'and was canceled.')
+        return FakeQueryStatus(time.monotonic() - submitted_at < self.query_seconds)
+
+    @staticmethod
+    def is_still_running(status: FakeQueryStatus) -> bool:
+        return status.running
+
+    def close(self) -> None:
+        pass
+
+
+class FakeSnowflakeHook:
+    '''Drop-in replacement for SnowflakeHook backed by one shared SQLite database.'''
+
+    query_seconds = 0.05
+    _db = None
+    _lock = threading.Lock()
+
+    def __init__(self, snowflake_conn_id: str = None, **kwargs):
+        self.snowflake_conn_id = snowflake_conn_id
+
+    @classmethod
+    def seed(cls, test_names: list, rows_per_test: int = 20) -> None:
+        # Creates the table the compiled SQL of failing tests selects from
+        with cls._lock:
+            cls._db = sqlite3.connect(':memory:', check_same_thread=False)
+            cls._db.execute(f'create table {FAILED_ROWS_TABLE} (test_name text, id integer, customer_id integer, amount real)')
+            cls._db.executemany(
+                f'insert into {FAILED_ROWS_TABLE} values (?, ?, ?, ?)',
+                ((name, row, row * 7, row * 1.5) for name in test_names for row in range(rows_per_test)))
+
+    def get_conn(self) -> FakeSnowflakeConnection:
+        if FakeSnowflakeHook._db is None:
+            FakeSnowflakeHook.seed([])
+        return FakeSnowflakeConnection(FakeSnowflakeHook._db, self.query_seconds)
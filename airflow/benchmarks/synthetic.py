@@ -0,0 +1,253 @@
+"""Synthetic dbt Cloud data for the offline benchmarks.
+
+Everything is generated from a seed so repeated benchmark runs see the same
+projects, runs, manifests and resource statuses.
+"""
+import random
+from datetime import datetime, timedelta
+
+
+ACCOUNT_ID = 1
+DBT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f+00:00'
+# Table queried by the compiled SQL of tests that collect failed test rows
+FAILED_ROWS_TABLE = 'failing_rows'
+
+SQL_LINE = 'select orders.id, orders.customer_id, sum(order_items.amount) as amount from analytics.orders\n'
+
+
+def dbt_time(value: datetime) -> str:
+    return value.strftime(DBT_TIME_FORMAT)
+
+
+class SyntheticAccount:
+    '''A dbt Cloud account with projects, environments, jobs and one shared manifest per project.
+
+    Args:
+        run_count: number of runs that finish inside the data interval.
+        resource_count: number of model, test, seed and snapshot nodes per project.
+        selected_fraction: fraction of the project resources each run builds.
+        failing_run_fraction: fraction of runs with a failing test that collects failed test rows.
+        macro_count: number of macros in the manifest. Macros are never sent to NR1 but make
+            up a large part of a real manifest.json.
+    '''
+
+    def __init__(self,
+                 run_count: int,
+                 interval_start: datetime,
+                 interval_end: datetime,
+                 resource_count: int = 200,
+                 selected_fraction: float = 0.25,
+                 failing_run_fraction: float = 0.05,
+                 macro_count: int = 200,
+                 project_count: int = 3,
+                 jobs_per_project: int = 5,
+                 seed: int = 0):
+        self.rng = random.Random(seed)
+        self.resource_count = resource_count
+        self.selected_fraction = selected_fraction
+        self.failing_run_fraction = failing_run_fraction
+        self.macro_count = macro_count
+        self.seed = seed
+
+        self.projects = {}
+        self.environments = {}
+        self.jobs = []
+        for project_index in range(project_count):
+            project_id = 100 + project_index
+            self.projects[project_id] = {
+                'id': project_id,
+                'account_id': ACCOUNT_ID,
+                'name': f'analytics_{project_index}',
+                'dbt_project_subdirectory': None,
+                'connection': {'type': 'snowflake', 'account': 'secret', 'role': 'secret'},
+                'repository': {'remote_url': 'git@github.com:example/analytics.git', 'deploy_key': 'secret'},
+            }
+            for environment_index, environment_type in enumerate(('development', 'deployment')):
+                environment_id = 1000 + project_index * 10 + environment_index
+                self.environments[environment_id] = {
+                    'id': environment_id,
+                    'account_id': ACCOUNT_ID,
+                    'project_id': project_id,
+                    'name': f'{environment_type}_{project_index}',
+                    'type': environment_type,
+                    'credentials': {'user': 'secret', 'password': 'secret'},
+                    'dbt_version': '1.7.0-latest',
+                }
+            for job_index in range(jobs_per_project):
+                job_id = 10000 + project_index * 100 + job_index
+                self.jobs.append({
+                    'id': job_id,
+                    'account_id': ACCOUNT_ID,
+                    'project_id': project_id,
+                    'environment_id': 1000 + project_index * 10 + 1,
+                    'name': f'Job {job_index} of project {project_index}',
+                    'description': 'Builds the analytics models',
+                    'execute_steps': ['dbt build --select tag:daily'],
+                    'generate_docs': False,
+                    'run_generate_sources': False,
+                    'state': 1,
+                    'triggers': {'github_webhook': False, 'schedule': True},
+                    'settings': {'threads': 8, 'target_name': 'prod'},
+                    'schedule': {'cron': '0 * * * *'},
+                })
+
+        # Runs finish inside the range get_dbt_runs queries, which is shifted five minutes back
+        range_start = interval_start - timedelta(minutes=5)
+        range_seconds = (interval_end - interval_start).total_seconds()
+        self.runs = []
+        for run_index in range(run_count):
+            job = self.jobs[run_index % len(self.jobs)]
+            finished_at = range_start + timedelta(seconds=range_seconds * (run_index + 0.5) / run_count)
+            self.runs.append(self._make_run(500000 + run_index, job, finished_at))
+
+        self.manifests = {project_id: self._make_manifest(project_id) for project_id in self.projects}
+
+    def _make_run(self, run_id: int, job: dict, finished_at: datetime) -> dict:
+        duration = 60 + self.rng.randint(0, 3000)
+        started_at = finished_at - timedelta(seconds=duration)
+        status = 20 if self.rng.random() < 0.05 else 10
+        return {
+            'id': run_id,
+            'trigger_id': run_id + 1,
+            'account_id': ACCOUNT_ID,
+            'environment_id': job['environment_id'],
+            'project_id': job['project_id'],
+            'job_definition_id': job['id'],
+            'status': status,
+            'dbt_version': '1.7.0-latest',
+            'git_branch': 'main',
+            'git_sha': f'{job["project_id"]:040x}',
+            'status_message': None if status == 10 else 'Database Error in model orders',
+            'owner_thread_id': None,
+            'executed_by_thread_id': 'dbt-run-abc',
+            'deferring_run_id': None,
+            'artifacts_saved': True,
+            'artifact_s3_path': f'prod/runs/{run_id}/artifacts/target',
+            'has_docs_generated': False,
+            'has_sources_generated': False,
+            'notifications_sent': True,
+            'blocked_by': [],
+            'created_at': dbt_time(started_at - timedelta(seconds=5)),
+            'updated_at': dbt_time(finished_at),
+            'dequeued_at': dbt_time(started_at - timedelta(seconds=2)),
+            'started_at': dbt_time(started_at),
+            'finished_at': dbt_time(finished_at),
+            'last_checked_at': dbt_time(finished_at),
+            'last_heartbeat_at': dbt_time(finished_at),
+            'should_start_allocation': True,
+            'trigger': {'id': run_id + 1, 'cause': 'Scheduled', 'job_definition_id': job['id']},
+            'job': job,
+            'run_steps': [],
+            'status_humanized': 'Success' if status == 10 else 'Error',
+            'in_progress': False,
+            'is_complete': True,
+            'is_success': status == 10,
+            'is_error': status == 20,
+            'is_cancelled': False,
+            'duration': f'{duration // 3600:02d}:{duration // 60 % 60:02d}:{duration % 60:02d}',
+            'queued_duration': '00:00:05',
+            'run_duration': f'{duration // 3600:02d}:{duration // 60 % 60:02d}:{duration % 60:02d}',
+            'duration_humanized': f'{duration // 60} minutes',
+            'job_id': job['id'],
+            'is_running': None,
+        }
+
+    def _make_manifest(self, project_id: int) -> dict:
+        nodes = {}
+        for index in range(self.resource_count):
+            kind = index % 20
+            if kind < 11:
+                resource_type = 'model'
+            elif kind < 18:
+                resource_type = 'test'
+            elif kind < 19:
+                resource_type = 'seed'
+            else:
+                resource_type = 'snapshot'
+            unique_id = f'{resource_type}.analytics_{project_id}.{resource_type}_{index}'
+            node = {
+                'unique_id': unique_id,
+                'resource_type': resource_type,
+                'name': f'{resource_type}_{index}',
+                'alias': f'{resource_type}_{index}',
+                'database': 'ANALYTICS',
+                'schema': 'PROD',
+                'path': f'{resource_type}s/{resource_type}_{index}.sql',
+                'original_file_path': f'models/{resource_type}s/{resource_type}_{index}.sql',
+                'description': f'Description of {resource_type} {index}. ' * 3,
+                'meta': {'owner': 'analytics'},
+                'config': {
+                    'enabled': True,
+                    'materialized': 'table',
+                    'tags': ['daily'],
+                    'meta': {'nr_config': {'team': 'Analytics', 'alert_failed_test_rows': resource_type == 'test',
+                                           'failed_test_row_limit': 10}},
+                    'severity': 'ERROR',
+                },
+                'raw_code': SQL_LINE * 20,
+                'compiled_code': SQL_LINE * 25,
+                'depends_on': {'macros': [], 'nodes': [f'model.analytics_{project_id}.model_{index // 2}']},
+                'columns': {f'column_{column}': {'name': f'column_{column}', 'description': 'A column'}
+                            for column in range(10)},
+                'checksum': {'name': 'sha256', 'checksum': f'{index:064x}'},
+            }
+            if resource_type == 'test':
+                node['test_metadata'] = {
+                    'name': 'not_null',
+                    'namespace': None,
+                    'kwargs': {'column_name': 'id', 'model': f"{{{{ get_where_subquery(ref('model_{index // 2}')) }}}}"},
+                }
+            nodes[unique_id] = node
+
+        macros = {
+            f'macro.analytics_{project_id}.macro_{index}': {
+                'name': f'macro_{index}',
+                'macro_sql': '{% macro example() %}' + SQL_LINE * 10 + '{% endmacro %}',
+                'arguments': [],
+            }
+            for index in range(self.macro_count)
+        }
+        return {
+            'metadata': {'dbt_version': '1.7.0', 'project_id': str(project_id)},
+            'nodes': nodes,
+            'sources': {},
+            'macros': macros,
+            'docs': {},
+            'exposures': {},
+            'metrics': {},
+            'parent_map': {unique_id: node['depends_on']['nodes'] for unique_id, node in nodes.items()},
+            'child_map': {},
+        }
+
+    def get_run(self, run_id: int) -> dict:
+        return self.runs[run_id - 500000]
+
+    def resource_statuses(self, run_id: int) -> dict:
+        # Statuses of the resources a run built, by resource type, in the shape of the discovery API
+        run = self.get_run(run_id)
+        rng = random.Random(self.seed * 1000003 + run_id)
+        manifest = self.manifests[run['project_id']]
+        failing_run = rng.random() < self.failing_run_fraction
+        statuses = {'model': [], 'test': [], 'seed': [], 'snapshot': []}
+        for unique_id, node in manifest['nodes'].items():
+            if rng.random() >= self.selected_fraction:
+                continue
+            resource_type = node['resource_type']
+            status = 'success' if resource_type != 'test' else 'pass'
+            if resource_type == 'test' and failing_run and not any(s['status'] == 'fail' for s in statuses['test']):
+                status = 'fail'
+            elif resource_type == 'model' and rng.random() < 0.01:
+                status = 'error'
+            statuses[resource_type].append({
+                'unique_id': unique_id,
+                'name': node['name'],
+                'status': status,
+                'resource_type': resource_type,
+                'compiled_sql': self.compiled_sql(node, status),
+            })
+        return statuses
+
+    def compiled_sql(self, node: dict, status: str) -> str:
+        if node['resource_type'] == 'test' and status == 'fail':
+            return f"select * from {FAILED_ROWS_TABLE} where test_name = '{node['name']}'"
+        return node['compiled_code']
@@ -2,243 +2,578 @@
 import pendulum
 import os
 import uuid
-import json
+import asyncio
+import functools
+import threading
 from airflow.decorators import dag, task
+from airflow.operators.python import get_current_context
 from airflow.models import XCom, Variable
+from airflow.models.param import Param
 from airflow.utils.db import create_session
-from airflow.providers.http.operators.http import HttpOperator
 # Import utility functions
 from nr_utils.snowflake import get_failed_test_rows
 from nr_utils.nr_utils import (
     flatten_dict,
+    flatten_records,
     get_team_from_run,
     extract_time_components,
     read_config
 
 )
 from nr_utils.dbt_cloud import (
-    dbt_cloud_response_filter,
-    dbt_cloud_secure_response_filter,
-    dbt_cloud_validation,
-    paginate_dbt_cloud_api_response,
-    get_dbt_cloud_manifest,
-    get_dbt_cloud_manifest_filtered,
+    DbtCloudClient,
+    get_dbt_cloud_catalog,
+    get_dbt_cloud_catalog_items,
+    get_dbt_cloud_manifest_index,
+    get_dbt_cloud_runs,
+    get_dbt_cloud_runs_windowed,
     get_dbt_cloud_run_results,
+    get_dbt_cloud_run_results_batch,
+    get_dbt_cloud_resource_details,
+    split_discovery_queries,
 )
-from nr_utils.http import upload_data
+from nr_utils.catalog_cache import CatalogCache
+from nr_utils.manifest_cache import ManifestCache
+from nr_utils.manifest_index import ManifestIndex
+from nr_utils.ledger import RunLedger, JOB_RUN, RESOURCE_RUN, FAILED_TEST_ROW, RESOURCE_DEFINITION
+from nr_utils.payload_store import PayloadStore, load_payload
+from nr_utils.nerdgraph import get_nrql_unique_run_ids
+from nr_utils.http import get_upload_target, upload_data, upload_data_async
+from nr_utils.pipeline import run_fetch_upload_pipeline
+from nr_utils import rate_limit, telemetry
 
 
 current_directory = os.path.dirname(os.path.abspath(__file__))
-file_path = os.path.join(current_directory,'dag_config.yml')
-config = read_config(file_path)
-connections = config['connections']
-dbt_cloud_admin_api = connections['dbt_cloud_admin_api']
-nr_insights_query = connections['nr_insights_query']
-dbt_cloud_discovery_api =  connections['dbt_cloud_discovery_api']
-nr_insights_insert = connections['nr_insights_insert']
-snowflake_api =  connections['snowflake_api']
-default_team = config['default_team']
-# New Relic account id used for NerdGraph queries.
-# Prefer Airflow Variable 'new_relic_account_id', then dag_config.yml, then environment variable NEW_RELIC_ACCOUNT_ID.
-nr_account_id = None
-try:
-    nr_account_id = Variable.get('nr_account_id', default_var=None)
-except Exception:
-    # Variable may not be available in some contexts; ignore and try other sources
-    nr_account_id = None
+# Used when dag_config.yml has no dags list
+DEFAULT_DAG_ID = 'new_relic_data_pipeline_observability_get_dbt_run_metadata2'
+DEFAULT_SCHEDULE = '5,15,25,35,45,55 * * * *'
+
+# dag_id of the DAG whose task runs in this process. Set when a task starts and used to pick its config
+_active_dag_id = None
+
+
+# Parsing this file only reads dag_config.yml, to build the DAGs in its dags list. Airflow Variables,
+# dbt_discovery_queries.yml and provider modules are loaded the first time a task needs them and kept
+# for the life of the worker process.
+@functools.lru_cache(maxsize=None)
+def get_config() -> dict:
+    return read_config(os.path.join(current_directory, 'dag_config.yml'))
+
+
+def get_dag_entries() -> list:
+    entries = get_config().get('dags') or [{'dag_id': DEFAULT_DAG_ID}]
+    dag_ids = [entry['dag_id'] for entry in entries]
+    if len(set(dag_ids)) != len(dag_ids):
+        raise Exception(f'dag_ids in the dags list of dag_config.yml must be unique: {dag_ids}')
+    return entries
+
+
+@functools.lru_cache(maxsize=None)
+def get_dag_config(dag_id: str = None) -> dict:
+    # dag_config.yml with the dags entry of dag_id merged over it. Sections of the entry, for instance
+    # connections or upload, are merged key by key and other values replace the shared ones
+    config = get_config()
+    merged = {key: dict(value) if isinstance(value, dict) else value for key, value in config.items() if key != 'dags'}
+    if dag_id is None:
+        return merged
+    entries = [entry for entry in get_dag_entries() if entry['dag_id'] == dag_id]
+    if not entries:
+        raise Exception(f'DAG {dag_id} is not in the dags list of dag_config.yml')
+    for key, value in entries[0].items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def get_active_config() -> dict:
+    # Config of the DAG of the running task, or the shared config outside of a task
+    return get_dag_config(_active_dag_id)
+
+
+def config_section(name: str) -> dict:
+    # Sections of dag_config.yml, for instance upload or manifest. Missing sections are empty
+    config = get_active_config()
+    if not config.get(name):
+        config[name] = {}
+    return config[name]
+
 
-if not nr_account_id:
-    nr_account_id = config.get('nrc_account_id') or os.environ.get('NEW_RELIC_ACCOUNT_ID')
+def get_conn_id(name: str) -> str:
+    # Airflow connection id of dbt_cloud_admin_api, dbt_cloud_discovery_api, nr_insights_query,
+    # nr_insights_insert or snowflake_api
+    return get_active_config()['connections'][name]
 
-if not nr_account_id:
-    raise Exception("Missing New Relic account id. Set Airflow Variable 'nr_account_id', add 'nr_account_id' to dag_config.yml, or set NEW_RELIC_ACCOUNT_ID environment variable")
 
-nr_account_id = int(nr_account_id)
+def get_nr_account_id() -> int:
+    return load_nr_account_id(_active_dag_id)
 
 
-@dag(
-    # Set start_date and catchup=True to get historical data
-    start_date=pendulum.datetime(2024, 6, 10, tz="UTC"),
-    catchup=False,
-    tags=[],
-    max_active_runs=3,
-    schedule="5,15,25,35,45,55 * * * *",
-    default_args={
+@functools.lru_cache(maxsize=None)
+def load_nr_account_id(dag_id: str = None) -> int:
+    # New Relic account id used for NerdGraph queries.
+    # Prefer Airflow Variable 'nr_account_id', then dag_config.yml, then environment variable NEW_RELIC_ACCOUNT_ID.
+    nr_account_id = None
+    try:
+        nr_account_id = Variable.get('nr_account_id', default_var=None)
+    except Exception:
+        # Variable may not be available in some contexts; ignore and try other sources
+        nr_account_id = None
+
+    if not nr_account_id:
+        nr_account_id = get_dag_config(dag_id).get('nrc_account_id') or os.environ.get('NEW_RELIC_ACCOUNT_ID')
+
+    if not nr_account_id:
+        raise Exception("Missing New Relic account id. Set Airflow Variable 'nr_account_id', add 'nr_account_id' to dag_config.yml, or set NEW_RELIC_ACCOUNT_ID environment variable")
+
+    return int(nr_account_id)
+
+
+@functools.lru_cache(maxsize=None)
+def get_discovery_queries() -> list:
+    # dbt_discovery_queries.yml is read once per worker process. Callers must not modify the result
+    return read_config(os.path.join(current_directory, 'dbt_discovery_queries.yml'))
+
+# Event types checked with NRQL for runs that were already sent
+NRQL_EVENT_TYPES = {
+    'run_query': 'dbt_job_run',
+    'resource_run_query': 'dbt_resource_run',
+    'failed_test_row_query': 'dbt_failed_test_row',
+}
+
+
+def get_run_range(data_interval_start, data_interval_end, params=None) -> tuple:
+    # Returns the range of finished_at to get runs for and whether this is a backfill. Backfills are
+    # started by triggering the DAG with backfill_start and backfill_end
+    params = params or {}
+    if params.get('backfill_start') and params.get('backfill_end'):
+        return pendulum.parse(params['backfill_start']), pendulum.parse(params['backfill_end']), True
+    # Shift the interval five minutes to account for API latency
+    return data_interval_start.subtract(minutes=5), data_interval_end.subtract(minutes=5), False
+
+
+def offload_payload(value):
+    # Large task results are written to the payload store and only a reference goes through XCom
+    payload_store_config = config_section('payload_store')
+    if not payload_store_config.get('path'):
+        return value
+    store = PayloadStore(payload_store_config['path'], min_bytes=payload_store_config.get('min_bytes', 65536))
+    context = get_current_context()
+    return store.offload(value, context['dag'].dag_id, context['run_id'])
+
+
+def get_run_ledger():
+    # The run ledger is optional. Without it, deduplication relies on NRQL only
+    ledger_path = config_section('idempotency').get('ledger_path')
+    if ledger_path:
+        return RunLedger(ledger_path)
+    return None
+
+
+def get_catalog_cache():
+    # The catalog cache is optional. Without it, projects and environments are listed on every DAG run
+    catalog_cache_config = config_section('catalog_cache')
+    if catalog_cache_config.get('path'):
+        # DAGs of different dbt Cloud accounts keep separate catalogs
+        path, extension = os.path.splitext(catalog_cache_config['path'])
+        path = f"{path}_{get_conn_id('dbt_cloud_admin_api')}{extension}"
+        return CatalogCache(path, catalog_cache_config.get('ttl_minutes', 1440) * 60)
+    return None
+
+
+def filter_dbt_runs(runs: list) -> list:
+    # Keeps the runs of the jobs, projects and environments listed in the dags entry of the DAG.
+    # A DAG without these filters processes every run of its dbt Cloud account
+    config = get_active_config()
+    filters = {
+        'job_definition_id': config.get('job_ids'),
+        'project_id': config.get('project_ids'),
+        'environment_id': config.get('environment_ids'),
+    }
+    for key, ids in filters.items():
+        if ids:
+            ids = {str(value) for value in ids}
+            runs = [run for run in runs if str(run[key]) in ids]
+    return runs
+
+
+def add_missing_catalog_items(runs: list, projects: dict, environments: dict) -> None:
+    # Runs can belong to a project or environment created after the catalog was cached. Those are
+    # looked up by id, or the whole listing is refreshed when there are many of them
+    catalog = {'projects': (projects, 'project_id'), 'environments': (environments, 'environment_id')}
+    missing = {listing: {str(run[key]) for run in runs} - set(items) for listing, (items, key) in catalog.items()}
+    if not any(missing.values()):
+        return
+    with DbtCloudClient(get_conn_id('dbt_cloud_admin_api'), **config_section('dbt_cloud_client')) as client:
+        for listing, ids in missing.items():
+            if ids:
+                print(f'Found unknown {listing} {sorted(ids)}')
+                catalog[listing][0].update(get_dbt_cloud_catalog_items(
+                    client, listing, ids, get_catalog_cache(),
+                    max_single_requests=config_section('catalog_cache').get('max_single_requests', 10)))
+
+
+def mark_uploaded(family: str, run_ids: list) -> None:
+    ledger = get_run_ledger()
+    if ledger:
+        ledger.mark_uploaded(family, run_ids)
+
+
+def emit_telemetry() -> None:
+    # Sends the spans recorded by the current task as dbt_integration_perf events. Telemetry
+    # is best effort and never fails the task
+    spans = telemetry.drain_spans()
+    if not config_section('telemetry').get('enabled', False) or not spans:
+        return
+    try:
+        context = get_current_context()
+        events = telemetry.build_events(
+            spans, dag_id=context['dag'].dag_id, dag_run_id=context['run_id'], task_id=context['ti'].task_id,
+            map_index=getattr(context['ti'], 'map_index', -1))
+        upload_data(events, get_conn_id('nr_insights_insert'), chunk_size=500, **config_section('upload'))
+    except Exception as e:
+        print(f'Could not send telemetry. Exception: {e}')
+    finally:
+        # Spans of the telemetry upload itself are not sent
+        telemetry.drain_spans()
+
+
+def with_task_context(function):
+    # Selects the config of the DAG the task belongs to, records the task as a span and sends every
+    # span recorded while it ran once it finishes
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        global _active_dag_id
+        _active_dag_id = get_current_context()['dag'].dag_id
+        telemetry.enable(config_section('telemetry').get('enabled', False))
+        rate_limit.configure(config_section('rate_limits'))
+        # Spans left over from an earlier task in the same worker process
+        telemetry.drain_spans()
+        try:
+            with telemetry.span('task', task=function.__name__):
+                return function(*args, **kwargs)
+        finally:
+            emit_telemetry()
+    return wrapper
+
+
+def get_resource_run_events(run: dict,
+                            query_list: list,
+                            admin_client: DbtCloudClient,
+                            discovery_client: DbtCloudClient,
+                            manifest_cache: ManifestCache = None,
+                            status_dict: dict = None,
+                            detail_queries: dict = None) -> tuple:
+    # Gets and enriches the resource runs of a single run. Returns the flattened resource run events
+    # and the failed tests that need failed test row processing. status_dict can be passed in when
+    # the discovery results were already fetched together with other runs. detail_queries is set
+    # for two phase discovery, where status_dict does not have the heavy fields yet
+    resource_run_statuses = []
+    failed_tests = []
+    run_id = run['run_id']
+    job_id = run['job_id']
+    # Get run metadata
+    if run['run_status'] not in (10, 20):
+        print(f'Run {run["run_id"]} did not complete. Not getting models and tests')
+        return resource_run_statuses, failed_tests
+
+    if status_dict is None:
+        status_dict = get_dbt_cloud_run_results(job_id, run_id, discovery_client, query_list)
+    statuses = status_dict['models'] + status_dict['snapshots'] + status_dict['seeds'] + status_dict['tests']
+    if not statuses:
+        print(f'Found 0 resource runs for run_id: {run_id}')
+        return resource_run_statuses, failed_tests
+
+    # Manifest contains all resources even if they were not run. Only the resources in the
+    # discovery results are looked up, so only those are filtered
+    manifest = get_dbt_cloud_manifest_index(
+        run, admin_client,
+        unique_ids={status['unique_id'] for status in statuses},
+        manifest_cache=manifest_cache,
+        streaming=config_section('manifest').get('streaming', True),
+        chunk_size=config_section('manifest').get('chunk_size', 1024 * 1024))
+
+    if detail_queries:
+        add_resource_details(run, status_dict, manifest, discovery_client, detail_queries)
+
+    normalized = config_section('normalized_events').get('enabled', False)
+    # dbt_resource_definition events of the run by definition_id, only used for normalized events
+    definitions = {}
+    for status in statuses:
+        resource_metadata = manifest.get(status['unique_id'])
+        if resource_metadata is None: # check in case some runs don't have a manifest file
+            print(f"key not found error: '{status['unique_id']}' not found in manifest for run_id: {run_id}")
+            continue
+        resource_fields = resource_metadata.to_dict()
+        event = status
+        if normalized:
+            # Keep the discovery fields and refer to the run and the definition by key
+            definition_id = manifest.definition_id(status['unique_id'])
+            if definition_id not in definitions:
+                definitions[definition_id] = get_resource_definition_event(resource_fields, definition_id)
+            event = get_normalized_resource_run_event(status, run, resource_fields, definition_id)
+        status.update(resource_fields)
+        status.update(run)
+        event['eventType'] = 'dbt_resource_run'
+        event['entity_name'] = f'{status["alias"]} - {status["run_created_at"]}'
+        event['entity_id'] = f'{uuid.uuid4()}'
+        event['dbt_source'] = 'Dbt Cloud'
+        # Save failed tests that need failed test row processing. They keep every attribute
+        if status['status'] in ('warn', 'fail') and status['alert_failed_test_rows']:
+            failed_tests.append(status.copy())
+        resource_run_statuses.append(event)
+
+    resource_run_statuses = flatten_records(resource_run_statuses + list(definitions.values()))
+    print(f'Found {len(resource_run_statuses) - len(definitions)} resource runs for run_id: {run_id}')
+    return resource_run_statuses, failed_tests
+
+
+def get_resource_definition_event(resource_fields: dict, definition_id: str) -> dict:
+    definition = dict(resource_fields)
+    definition['definition_id'] = definition_id
+    definition['eventType'] = RESOURCE_DEFINITION
+    definition['dbt_source'] = 'Dbt Cloud'
+    return definition
+
+
+def get_normalized_resource_run_event(status: dict, run: dict, resource_fields: dict, definition_id: str) -> dict:
+    # Slim dbt_resource_run event. Other run attributes are joined from dbt_job_run on run_id and other
+    # manifest attributes from dbt_resource_definition on definition_id. run_id is always kept since
+    # it is the join key and the run ledger records uploads by run_id
+    event = dict(status)
+    event['definition_id'] = definition_id
+    event['run_id'] = run['run_id']
+    for attribute in config_section('normalized_events').get('run_attributes', ['run_id', 'job_id']):
+        event[attribute] = run.get(attribute)
+    for attribute in config_section('normalized_events').get('definition_attributes', ['resource_type', 'alias']):
+        event[attribute] = resource_fields.get(attribute)
+    return event
+
+
+def drop_sent_definitions(events: list, sent_definition_ids: set) -> list:
+    # Removes dbt_resource_definition events that this task or an earlier run already sent. The definitions
+    # that are kept are added to sent_definition_ids, so callers that share the set must hold a lock
+    definition_ids = {event['definition_id'] for event in events if event['eventType'] == RESOURCE_DEFINITION}
+    new_definition_ids = definition_ids - sent_definition_ids
+    ledger = get_run_ledger()
+    if ledger and new_definition_ids:
+        new_definition_ids -= ledger.uploaded_run_ids(RESOURCE_DEFINITION, list(new_definition_ids))
+    sent_definition_ids |= definition_ids
+    return [event for event in events
+            if event['eventType'] != RESOURCE_DEFINITION or event['definition_id'] in new_definition_ids]
+
+
+def add_resource_details(run: dict,
+                         status_dict: dict,
+                         manifest: ManifestIndex,
+                         discovery_client: DbtCloudClient,
+                         detail_queries: dict) -> None:
+    # Second phase of two phase discovery. Compiled SQL and code are only fetched for resources
+    # with a status in detail_statuses and for tests that collect failed test rows
+    detail_statuses = config_section('discovery').get('detail_statuses', ['error', 'fail', 'warn'])
+    resources = []
+    for resource_type, resource_statuses in status_dict.items():
+        if resource_type not in detail_queries:
+            continue
+        for status in resource_statuses:
+            resource_metadata = manifest.get(status['unique_id'])
+            if status['status'] in detail_statuses or (resource_metadata and resource_metadata.alert_failed_test_rows):
+                resources.append((resource_type, status['unique_id']))
+    if not resources:
+        return
+
+    details = get_dbt_cloud_resource_details(
+        run['job_id'], run['run_id'], resources, discovery_client, detail_queries,
+        resources_per_request=config_section('discovery').get('detail_resources_per_request', 100))
+    print(f'Fetched details of {len(details)} resources for run_id: {run["run_id"]}')
+    for resource_statuses in status_dict.values():
+        for status in resource_statuses:
+            if status['unique_id'] in details:
+                status.update(details[status['unique_id']])
+
+
+def get_resource_run_batch_events(runs: list,
+                                  query_list: list,
+                                  admin_client: DbtCloudClient,
+                                  discovery_client: DbtCloudClient,
+                                  manifest_cache: ManifestCache = None,
+                                  detail_queries: dict = None) -> tuple:
+    # Gets the discovery API results for a batch of runs with a single request, then enriches each run
+    completed_runs = [run for run in runs if run['run_status'] in (10, 20)]
+    status_dicts = {}
+    if len(completed_runs) > 1:
+        run_keys = [(run['job_id'], run['run_id']) for run in completed_runs]
+        status_dicts = get_dbt_cloud_run_results_batch(run_keys, discovery_client, query_list)
+
+    resource_run_statuses = []
+    failed_tests = []
+    for run in runs:
+        run_statuses, run_failed_tests = get_resource_run_events(
+            run, query_list, admin_client, discovery_client, manifest_cache, status_dicts.get(run['run_id']),
+            detail_queries)
+        resource_run_statuses += run_statuses
+        failed_tests += run_failed_tests
+    return resource_run_statuses, failed_tests
+
+
+def create_dag(dag_config: dict):
+    # Builds the DAG of one entry in the dags list of dag_config.yml. Every DAG runs the same tasks,
+    # each with its own connections, schedule, concurrency and job, project or environment filters
+    default_args = {
         'retries': 3,
         'retry_delay': pendulum.duration(seconds=30),
     }
-)
+    # Route the tasks of a DAG to its own Celery queue or pool so shards scale independently
+    for key in ('queue', 'pool'):
+        if dag_config.get(key):
+            default_args[key] = dag_config[key]
+    dag_kwargs = {}
+    if dag_config.get('max_active_tasks'):
+        dag_kwargs['max_active_tasks'] = dag_config['max_active_tasks']
+
+    @dag(
+        dag_id=dag_config['dag_id'],
+        # Set start_date and catchup=True to get historical data
+        start_date=pendulum.datetime(2024, 6, 10, tz="UTC"),
+        catchup=dag_config.get('catchup', False),
+        tags=dag_config.get('tags', []),
+        max_active_runs=dag_config.get('max_active_runs', 3),
+        schedule=dag_config.get('schedule', DEFAULT_SCHEDULE),
+        default_args=default_args,
+        # Trigger with backfill_start and backfill_end (ISO 8601) to process a longer range, for instance after an outage
+        params={
+            'backfill_start': Param(None, type=['null', 'string']),
+            'backfill_end': Param(None, type=['null', 'string']),
+        },
+        **dag_kwargs,
+    )
+    def dbt_cloud_run_metadata():
+        add_dbt_run_metadata_tasks(dag_config)
 
+    return dbt_cloud_run_metadata()
 
-def new_relic_data_pipeline_observability_get_dbt_run_metadata2():
 
-    get_dbt_runs = HttpOperator(
-        task_id='get_dbt_runs',
-        http_conn_id=dbt_cloud_admin_api,
-        method='GET',
-        endpoint='/runs/',
-        headers={
-            'Content-Type': "application/json",
-            'Authorization': 'Token {{conn.dbt_cloud_admin_api.password}}',
-        },
-        data={
-            # Shift the interval five minutes to account for API latency
-            'finished_at__range': '["{{data_interval_start.subtract(minutes=5)}}", "{{data_interval_end.subtract(seconds=0.000001, minutes=5)}}"]',
-            'include_related': ['job'],
-            'order_by': '-finished_at',
-        },
-        do_xcom_push=True,
-        pagination_function=paginate_dbt_cloud_api_response,
-        response_check=dbt_cloud_validation,
-        response_filter=dbt_cloud_response_filter
-    )
+def add_dbt_run_metadata_tasks(dag_config: dict):
+    # Tasks read their settings when they run. dag_config is only used here for settings that are part of the DAG
 
+    @task
+    @with_task_context
+    def get_dbt_runs(data_interval_start=None, data_interval_end=None, params=None):
+        finished_after, finished_before, backfill = get_run_range(data_interval_start, data_interval_end, params)
+        with DbtCloudClient(get_conn_id('dbt_cloud_admin_api'), **config_section('dbt_cloud_client')) as client:
+            if backfill:
+                runs = get_dbt_cloud_runs_windowed(
+                    client, finished_after, finished_before,
+                    window=pendulum.duration(minutes=config_section('backfill').get('window_minutes', 60)),
+                    max_concurrency=config_section('backfill').get('max_concurrent_windows', 4))
+            else:
+                runs = get_dbt_cloud_runs(client, finished_after, finished_before.subtract(seconds=0.000001))
+        dbt_cloud_run_count = len(runs)
+        runs = filter_dbt_runs(runs)
+        if len(runs) != dbt_cloud_run_count:
+            print(f'Processing {len(runs)} of {dbt_cloud_run_count} runs in the jobs, projects and environments of this DAG')
+        return offload_payload(runs)
 
-    get_dbt_projects = HttpOperator(
-        task_id='get_dbt_projects',
-        http_conn_id=dbt_cloud_admin_api,
-        method='GET',
-        endpoint='/projects/',
-        headers={
-            'Content-Type': "application/json",
-            'Authorization': 'Token {{conn.dbt_cloud_admin_api.password}}',
-        },
-        do_xcom_push=True,
-        pagination_function=paginate_dbt_cloud_api_response,
-        response_check=dbt_cloud_validation,
-        response_filter=dbt_cloud_secure_response_filter,
-    )
 
+    @task
+    @with_task_context
+    def get_dbt_projects():
+        with DbtCloudClient(get_conn_id('dbt_cloud_admin_api'), **config_section('dbt_cloud_client')) as client:
+            return get_dbt_cloud_catalog(client, 'projects', get_catalog_cache())
 
-    # Uses a different response filter because the environment can hold sensative data
-    get_dbt_environments = HttpOperator(
-        task_id='get_dbt_environments',
-        http_conn_id=dbt_cloud_admin_api,
-        method='GET',
-        endpoint='/environments/',
-        headers={
-            'Content-Type': "application/json",
-            'Authorization': 'Token {{conn.dbt_cloud_admin_api.password}}',
-        },
-        do_xcom_push=True,
-        pagination_function=paginate_dbt_cloud_api_response,
-        response_check=dbt_cloud_validation,
-        response_filter=dbt_cloud_secure_response_filter
-    )
+
+    # Only the id and name are kept because the environment can hold sensative data
+    @task
+    @with_task_context
+    def get_dbt_environments():
+        with DbtCloudClient(get_conn_id('dbt_cloud_admin_api'), **config_section('dbt_cloud_client')) as client:
+            return get_dbt_cloud_catalog(client, 'environments', get_catalog_cache())
 
 
     # Get run ids already in NR1. This improves idempotency
-    @task(multiple_outputs=True)
-    def get_nrql_queries(runs, data_interval_start=None):
-        if len(runs) > 200:
-            print(f'Too many runs to process. Ensure the DAG has a schedule or decrease the scheduled interval')
+    @task
+    @with_task_context
+    def get_nrql_queries(runs, data_interval_start=None, data_interval_end=None, params=None):
+        runs = load_payload(runs)
+        finished_after, _finished_before, backfill = get_run_range(data_interval_start, data_interval_end, params)
+        since = finished_after if backfill else data_interval_start
+        max_runs = config_section('idempotency').get('max_runs', 200)
+        if len(runs) > max_runs and not backfill:
+            print(f'Too many runs to process. Ensure the DAG has a schedule or decrease the scheduled interval. Use backfill_start and backfill_end to process a longer range')
             raise Exception('Too many runs to process')
 
         run_ids = [run['run_id'] for run in runs]
 
-        run_query = f"""
-            select uniques(run_id) from dbt_job_run
-            where run_id in ('{"', '".join(run_ids)}')
-            since '{data_interval_start.format("YYYY-MM-DD HH:mm:ss")}'
-        """
-        resource_run_query = f"""
-            select uniques(run_id) from dbt_resource_run
-            where run_id in ('{"', '".join(run_ids)}')
-            since '{data_interval_start.format("YYYY-MM-DD HH:mm:ss")}'
+        # Long IN lists are split so each query stays within the NRQL limits
+        queries = {}
+        chunk_size = config_section('idempotency').get('nrql_chunk_size', 200)
+        for index, start in enumerate(range(0, len(run_ids), chunk_size)):
+            chunk_ids = run_ids[start:start + chunk_size]
+            for query_name, event_type in NRQL_EVENT_TYPES.items():
+                queries[f'{query_name}_{index}'] = f"""
+            select uniques(run_id, {chunk_size}) from {event_type}
+            where run_id in ('{"', '".join(chunk_ids)}')
+            since '{since.format("YYYY-MM-DD HH:mm:ss")}'
         """
-        failed_test_row_query = f"""
-            select uniques(run_id) from dbt_failed_test_rows
-            where run_id in ('{"', '".join(run_ids)}')
-            since '{data_interval_start.format("YYYY-MM-DD HH:mm:ss")}'
-        """
-        queries = {
-            'run_query': run_query,
-            'resource_run_query': resource_run_query,
-            'failed_test_row_query': failed_test_row_query
-        }
         print(f'NR Run id query: {queries}')
-        return queries
+        return offload_payload(queries)
 
 
-    get_nr_run_ids = HttpOperator(
-        task_id='get_nr_run_ids',
-        http_conn_id=nr_insights_query,
-    method='POST',
-    endpoint='/graphql',
-        headers = {
-            'Content-Type': 'application/json',
-            'API-Key': '{{ conn.nr_insights_query.password}}',
-        },
-        data=json.dumps({
-            'query': 'query($accountId:Int!,$nrql:String!){ actor{ account(id:$accountId){ nrql(query:$nrql){ results } } } }',
-            'variables': {
-                'accountId': nr_account_id,
-                'nrql': "{{ task_instance.xcom_pull(task_ids='get_nrql_queries', key='run_query')}}",
-            },
-        }),
-        do_xcom_push=True,
-        response_filter=lambda response: response.json()['data']['actor']['account']['nrql']['results'][0]['members'],
-    )
-
-
-    get_nr_resource_run_ids = HttpOperator(
-        task_id='get_nr_resource_run_ids',
-        http_conn_id=nr_insights_query,
-    method='POST',
-    endpoint='/graphql',
-        headers = {
-            'Content-Type': 'application/json',
-            'API-Key': '{{ conn.nr_insights_query.password}}',
-        },
-        data=json.dumps({
-            'query': 'query($accountId:Int!,$nrql:String!){ actor{ account(id:$accountId){ nrql(query:$nrql){ results } } } }',
-            'variables': {
-                'accountId': nr_account_id,
-                'nrql': "{{ task_instance.xcom_pull(task_ids='get_nrql_queries', key='resource_run_query')}}",
-            },
-        }),
-        do_xcom_push=True,
-        response_filter=lambda response: response.json()['data']['actor']['account']['nrql']['results'][0]['members'],
-    )
-
-
-    get_nr_failed_test_row_run_ids = HttpOperator(
-        task_id='get_nr_failed_test_row_run_ids',
-        http_conn_id=nr_insights_query,
-    method='POST',
-    endpoint='/graphql',
-        headers = {
-            'Content-Type': 'application/json',
-            'API-Key': '{{ conn.nr_insights_query.password}}',
-        },
-        data=json.dumps({
-            'query': 'query($accountId:Int!,$nrql:String!){ actor{ account(id:$accountId){ nrql(query:$nrql){ results } } } }',
-            'variables': {
-                'accountId': nr_account_id,
-                'nrql': "{{ task_instance.xcom_pull(task_ids='get_nrql_queries', key='failed_test_row_query')}}",
-            },
-        }),
-        do_xcom_push=True,
-        response_filter=lambda response: response.json()['data']['actor']['account']['nrql']['results'][0]['members'],
-    )
+    # All three run id lookups share one NerdGraph request
+    @task(multiple_outputs=True)
+    @with_task_context
+    def get_nr_run_ids(queries):
+        queries = load_payload(queries)
+        if not config_section('idempotency').get('nrql_reconciliation', True):
+            print('NRQL reconciliation is disabled. Using the run ledger only')
+            return {'nr_runs': [], 'nr_resource_runs': [], 'nr_failed_test_row_runs': []}
+        run_ids = get_nrql_unique_run_ids(
+            queries, get_conn_id('nr_insights_query'), get_nr_account_id(),
+            queries_per_request=config_section('idempotency').get('nrql_queries_per_request', 9))
+        # Merge the chunks of each query
+        result = {'run_query': [], 'resource_run_query': [], 'failed_test_row_query': []}
+        for name, members in run_ids.items():
+            result[name.rsplit('_', 1)[0]] += members
+        return {
+            'nr_runs': result['run_query'],
+            'nr_resource_runs': result['resource_run_query'],
+            'nr_failed_test_row_runs': result['failed_test_row_query'],
+        }
 
 
-    # Compare runs from dbt cloud to run ids already in New Relic
+    # Compare runs from dbt cloud to run ids already in New Relic and in the run ledger
     @task(multiple_outputs=True)
+    @with_task_context
     def get_runs_to_process(runs, nr_runs, nr_resource_runs, nr_failed_test_runs):
+        runs = load_payload(runs)
+        nr_runs = set(nr_runs)
+        nr_resource_runs = set(nr_resource_runs)
+        nr_failed_test_runs = set(nr_failed_test_runs)
+        ledger = get_run_ledger()
+        if ledger:
+            run_ids = [run['run_id'] for run in runs]
+            nr_runs |= ledger.uploaded_run_ids(JOB_RUN, run_ids)
+            nr_resource_runs |= ledger.uploaded_run_ids(RESOURCE_RUN, run_ids)
+            nr_failed_test_runs |= ledger.uploaded_run_ids(FAILED_TEST_ROW, run_ids)
+            ledger.prune(config_section('idempotency').get('ledger_retention_days', 30))
+
         runs_to_process = list(filter(lambda run: run['run_id'] not in nr_runs, runs))
         resource_runs_to_process = list(filter(lambda run: run['run_id'] not in nr_resource_runs, runs))
-        failed_test_ids_to_process = [run['run_id'] for run in runs if run not in nr_failed_test_runs]
+        failed_test_ids_to_process = [run['run_id'] for run in runs if run['run_id'] not in nr_failed_test_runs]
         result = {
             'runs_to_process': runs_to_process,
             'resource_runs_to_process': resource_runs_to_process,
             'failed_test_runs_to_process': failed_test_ids_to_process
         }
-        return result
+        return {key: offload_payload(value) for key, value in result.items()}
 
 
     @task
+    @with_task_context
     def enrich_runs(runs_to_process, projects, environments):
+        runs_to_process = load_payload(runs_to_process)
+        add_missing_catalog_items(runs_to_process, projects, environments)
         processed_runs = []
         for raw_run in runs_to_process:
             # Add job information
@@ -275,85 +610,165 @@ def new_relic_data_pipeline_observability_get_dbt_run_metadata2():
 
             processed_runs.append(run)
 
-        return processed_runs
+        return offload_payload(processed_runs)
 
 
     @task
+    @with_task_context
     def process_runs(runs):
+        runs = load_payload(runs)
         if runs:
             print(f'Sending {len(runs)} to New Relic')
             print(f'Run ids: {[run["run_id"] for run in runs]}')
-            upload_data(runs, nr_insights_insert, chunk_size=500)
+            upload_data(runs, get_conn_id('nr_insights_insert'), chunk_size=500, **config_section('upload'))
+            mark_uploaded(JOB_RUN, [run['run_id'] for run in runs])
         else:
             print('No new runs to send')
         print('Send run complete')
 
 
-    @task(multiple_outputs=True)
-    def process_resource_runs(runs, failed_test_runs):
+    # Splits the runs into batches so each batch is processed by its own mapped task
+    @task
+    @with_task_context
+    def shard_resource_runs(runs):
+        runs = load_payload(runs)
+        runs_per_task = config_section('resource_runs').get('runs_per_task', 10)
+        shards = [runs[i:i + runs_per_task] for i in range(0, len(runs), runs_per_task)]
+        print(f'Processing {len(runs)} runs in {len(shards)} resource run tasks')
+        # Keep one empty shard so the tasks downstream of the mapped task still run
+        return [offload_payload(shard) for shard in shards] or [[]]
+
+
+    @task(max_active_tis_per_dagrun=(dag_config.get('resource_runs') or {}).get('max_active_tasks', 16))
+    @with_task_context
+    def process_resource_runs(runs):
+        runs = load_payload(runs)
         # Used to collect failed test that need failed test row processing
         all_failed_tests = []
-        for run in runs:
-            run_id = run['run_id']
-            job_id = run['job_id']
-            # Get run metadata
-            if run['run_status'] not in (10, 20):
-                print(f'Run {run["run_id"]} did not complete. Not getting models and tests')
-                continue
-
-            # Manifest contains all resources even if they were not run. This is how we can get the state of the project.
-            manifest_raw = get_dbt_cloud_manifest(run_id, dbt_cloud_admin_api)
-
-            manifest_filtered = get_dbt_cloud_manifest_filtered(manifest_raw)
-
-            manifest = {resource['unique_id']: resource for resource in manifest_filtered}
-
-            # Get run statuses
-            dbt_query_path = os.path.join(current_directory,'dbt_discovery_queries.yml')
-            query_list = read_config(dbt_query_path)
-
-            status_dict = get_dbt_cloud_run_results(job_id, run_id, dbt_cloud_discovery_api, query_list)
-            statuses = status_dict['models'] + status_dict['snapshots'] + status_dict['seeds'] + status_dict['tests']
-
-            resource_run_statuses = []
-
-            for status in statuses:
-                if status['unique_id'] not in manifest: # check in case some runs don't have a manifest file
-                    print(f"key not found error: '{status['unique_id']}' not found in manifest for run_id: {run_id}")
-                    continue
-                resource_metadata = manifest[status['unique_id']]
-                status.update(resource_metadata)
-                status.update(run)
-                status['eventType'] = 'dbt_resource_run'
-                status['entity_name'] = f'{status["alias"]} - {status["run_created_at"]}'
-                status['entity_id'] = f'{uuid.uuid4()}'
-                status['dbt_source'] = 'Dbt Cloud'
-                # Save failed tests that need failed test row processing
-                if status['status'] in ('warn', 'fail') and status['alert_failed_test_rows']:
-                    all_failed_tests.append(status.copy())
-                resource_run_statuses.append(flatten_dict(status, ''))
-
-            if resource_run_statuses:
-                print(f'Sending {len(resource_run_statuses)} resource runs')
-                upload_data(resource_run_statuses, nr_insights_insert, chunk_size=500)
-                print(f'Send complete')
+        manifest_config = config_section('manifest')
+        manifest_cache = None
+        if manifest_config.get('cache_dir'):
+            manifest_cache = ManifestCache(manifest_config['cache_dir'], manifest_config.get('cache_max_mb', 512) * 1024 * 1024)
+
+        # Get run statuses
+        query_list = get_discovery_queries()
+        detail_queries = None
+        discovery_config = config_section('discovery')
+        if discovery_config.get('two_phase', False):
+            # Heavy fields are left out of the first request and fetched per resource when needed
+            query_list, detail_queries = split_discovery_queries(query_list)
+
+        # Runs are independent, so we fetch several at once. Events are uploaded as soon as a batch of
+        # runs is fetched, while other runs are still being fetched. A failure in one run does not stop
+        # the others, but the task still fails once every run has finished.
+        # runs_per_request is the number of runs whose discovery API results are fetched in the same request
+        runs_per_request = discovery_config.get('runs_per_request', 1)
+
+        # A retry of this task gets the whole shard again. Runs uploaded by an earlier attempt are not sent
+        # twice. Their failed tests were recorded in the ledger when they were fetched, so they are only
+        # fetched again when the record is missing and failed test rows are still to be sent
+        runs_to_send, runs_for_failed_tests = runs, []
+        ledger = get_run_ledger()
+        if ledger and runs:
+            run_ids = [run['run_id'] for run in runs]
+            uploaded_run_ids = ledger.uploaded_run_ids(RESOURCE_RUN, run_ids)
+            if uploaded_run_ids:
+                recorded_failed_tests = ledger.failed_tests(list(uploaded_run_ids))
+                for tests in recorded_failed_tests.values():
+                    all_failed_tests += tests
+                failed_test_row_run_ids = ledger.uploaded_run_ids(FAILED_TEST_ROW, run_ids)
+                runs_to_send = [run for run in runs if str(run['run_id']) not in uploaded_run_ids]
+                runs_for_failed_tests = [run for run in runs if str(run['run_id']) in uploaded_run_ids
+                                         and str(run['run_id']) not in recorded_failed_tests
+                                         and str(run['run_id']) not in failed_test_row_run_ids]
+                print(f'Skipping {len(runs) - len(runs_to_send)} resource runs that were already uploaded, '
+                      f'{len(runs_for_failed_tests)} of them are fetched again for their failed tests')
+        # Batches are (runs, send_events) pairs
+        batches = [(runs_to_send[i:i + runs_per_request], True) for i in range(0, len(runs_to_send), runs_per_request)]
+        batches += [(runs_for_failed_tests[i:i + runs_per_request], False)
+                    for i in range(0, len(runs_for_failed_tests), runs_per_request)]
+        # One pooled client per API is shared by every thread
+        admin_client = DbtCloudClient(get_conn_id('dbt_cloud_admin_api'), **config_section('dbt_cloud_client'))
+        discovery_client = DbtCloudClient(get_conn_id('dbt_cloud_discovery_api'),
+                                          rate_limit_family=rate_limit.DISCOVERY_API,
+                                          **config_section('dbt_cloud_client'))
+        nr_insights_insert = get_conn_id('nr_insights_insert')
+        upload_target = get_upload_target(nr_insights_insert)
+
+        def fetch(item):
+            batch, send_events = item
+            events, failed_tests = get_resource_run_batch_events(batch, query_list, admin_client, discovery_client,
+                                                                 manifest_cache, detail_queries)
+            if ledger:
+                run_failed_tests = {str(run['run_id']): [] for run in batch}
+                for test in failed_tests:
+                    run_failed_tests.setdefault(str(test['run_id']), []).append(test)
+                ledger.record_failed_tests(run_failed_tests)
+            return (events if send_events else []), failed_tests
+
+        # Definitions sent by this task. Checked and reserved before uploading so each one is only sent once,
+        # under a lock because the uploaders check their batches at the same time
+        sent_definition_ids = set()
+        sent_definitions_lock = threading.Lock()
+
+        def drop_definitions(events):
+            with sent_definitions_lock:
+                return drop_sent_definitions(events, sent_definition_ids)
+
+        async def upload(events):
+            events = await asyncio.to_thread(drop_definitions, events)
+            resource_run_ids = [event['run_id'] for event in events if event['eventType'] == RESOURCE_RUN]
+            definition_ids = [event['definition_id'] for event in events if event['eventType'] == RESOURCE_DEFINITION]
+            print(f'Sending {len(resource_run_ids)} resource runs and {len(definition_ids)} resource definitions')
+            await upload_data_async(events, nr_insights_insert, chunk_size=500, target=upload_target, **config_section('upload'))
+            await asyncio.to_thread(mark_uploaded, RESOURCE_RUN, resource_run_ids)
+            await asyncio.to_thread(mark_uploaded, RESOURCE_DEFINITION, definition_ids)
+
+        with admin_client, discovery_client:
+            batch_failed_tests = asyncio.run(run_fetch_upload_pipeline(
+                batches, fetch, upload,
+                # Number of runs this task works on at the same time
+                max_concurrency=get_active_config().get('max_concurrent_runs', 8),
+                queue_size=config_section('pipeline').get('queue_size', 8),
+                uploaders=config_section('pipeline').get('uploaders', 2)))
+        for failed_tests in batch_failed_tests:
+            all_failed_tests += failed_tests
 
         print(f'Finished processing {len(runs)} resource runs')
-        return {
-            'failed_tests': all_failed_tests,
-            'failed_test_runs': failed_test_runs,
-        }
+        return offload_payload(all_failed_tests)
 
 
+    # Merges the failed tests returned by every mapped process_resource_runs task
     @task
+    @with_task_context
+    def collect_failed_tests(shard_failed_tests):
+        all_failed_tests = []
+        for failed_tests in shard_failed_tests:
+            all_failed_tests += load_payload(failed_tests)
+        print(f'Collected {len(all_failed_tests)} failed tests')
+        return offload_payload(all_failed_tests)
+
+
+    @task
+    @with_task_context
     def process_failed_test_rows(failed_tests, failed_test_runs):
+        failed_tests = load_payload(failed_tests)
+        failed_test_runs = load_payload(failed_test_runs)
         if failed_tests and failed_test_runs:
             # See if we already processed the failed tests
             failed_tests_to_process = [test for test in failed_tests if test['run_id'] in failed_test_runs]
-            failed_test_rows = get_failed_test_rows(failed_tests_to_process, snowflake_conn_id=snowflake_api)
+            failed_test_rows_config = config_section('failed_test_rows')
+            failed_test_rows = get_failed_test_rows(
+                failed_tests_to_process,
+                snowflake_conn_id=get_conn_id('snowflake_api'),
+                max_concurrent_queries=failed_test_rows_config.get('max_concurrent_queries', 8),
+                push_down_limit=failed_test_rows_config.get('push_down_limit', True),
+                query_timeout_seconds=failed_test_rows_config.get('query_timeout_seconds'),
+                arrow=failed_test_rows_config.get('arrow', True))
             # Send data to NR1
             print(f'Sending {len(failed_test_rows)} failed test rows')
-            upload_data(failed_test_rows, nr_insights_insert, chunk_size=500)
+            upload_data(failed_test_rows, get_conn_id('nr_insights_insert'), chunk_size=500, **config_section('upload'))
+            mark_uploaded(FAILED_TEST_ROW, [test['run_id'] for test in failed_tests_to_process])
         else:
             print('No failed tests to get failed test rows for')
 
@@ -362,6 +777,7 @@ def new_relic_data_pipeline_observability_get_dbt_run_metadata2():
 
 
     @task
+    @with_task_context
     def cleanup_xcom(message=None, **kwargs):
         dag_id = kwargs["ti"].dag_id
         run_id = kwargs["run_id"]
@@ -370,36 +786,41 @@ def new_relic_data_pipeline_observability_get_dbt_run_metadata2():
         with create_session() as session:
             session.query(XCom).filter(XCom.dag_id == dag_id, XCom.run_id == run_id).delete()
         print(f'Dag Xcoms deleted')
+        payload_store_path = config_section('payload_store').get('path')
+        if payload_store_path:
+            PayloadStore(payload_store_path).delete_run(dag_id, run_id)
+            print(f'Dag payloads deleted')
 
-    # Using a combination of taskflow and operators. Task flow automatically handles task dependencies in the DAG
+    # Task flow automatically handles task dependencies in the DAG
     # Get run data
-    dbt_projects = get_dbt_projects.output['return_value']
-    dbt_environments = get_dbt_environments.output['return_value']
-    dbt_runs = get_dbt_runs.output['return_value']
+    dbt_projects = get_dbt_projects()
+    dbt_environments = get_dbt_environments()
+    dbt_runs = get_dbt_runs()
     dbt_runs_enriched = enrich_runs(dbt_runs, dbt_projects, dbt_environments)
 
     # Get run ids to proces for runs, resource runs, and failed test runs
     nr_run_query = get_nrql_queries(dbt_runs_enriched)
-    nr_runs = get_nr_run_ids.output['return_value']
-    nr_resource_runs = get_nr_resource_run_ids.output['return_value']
-    nr_failed_test_row_runs = get_nr_failed_test_row_run_ids.output['return_value']
+    nr_run_ids = get_nr_run_ids(nr_run_query)
+    nr_runs = nr_run_ids['nr_runs']
+    nr_resource_runs = nr_run_ids['nr_resource_runs']
+    nr_failed_test_row_runs = nr_run_ids['nr_failed_test_row_runs']
     runs_to_process = get_runs_to_process(dbt_runs_enriched, nr_runs, nr_resource_runs, nr_failed_test_row_runs)
 
     # Process runs
     processed_runs = process_runs(runs_to_process['runs_to_process'])
 
-    failed_tests = process_resource_runs(
-        runs_to_process['resource_runs_to_process'],
-        runs_to_process['failed_test_runs_to_process'])
+    # One mapped task per shard of runs, so shards run on different workers and retry on their own
+    resource_run_shards = shard_resource_runs(runs_to_process['resource_runs_to_process'])
+    shard_failed_tests = process_resource_runs.expand(runs=resource_run_shards)
+    failed_tests = collect_failed_tests(shard_failed_tests)
 
     failed_test_rows = process_failed_test_rows(
-        failed_tests['failed_tests'],
-        failed_tests['failed_test_runs'])
+        failed_tests,
+        runs_to_process['failed_test_runs_to_process'])
 
     # Cleanup xcoms
     cleanup_xcom(failed_test_rows)
 
-    # Set operator dependencies that are not automatically set by task flow
-    nr_run_query >> [nr_runs, nr_resource_runs, nr_failed_test_row_runs]
 
-new_relic_data_pipeline_observability_get_dbt_run_metadata2()
+for dag_entry in get_dag_entries():
+    globals()[dag_entry['dag_id']] = create_dag(get_dag_config(dag_entry['dag_id']))
@@ -0,0 +1,66 @@
+import json
+import os
+import time
+import uuid
+from typing import Optional
+
+
+class CatalogCache:
+    '''Local JSON file with the dbt Cloud projects and environments of the account.
+
+    The catalog rarely changes, so every listing (projects, environments) is
+    refreshed in full at most once per ttl_seconds. Ids seen in between are
+    fetched one at a time and added without extending the TTL. Each listing
+    has its own file named after path, for instance catalog_projects.json, so
+    tasks refreshing different listings at the same time do not overwrite each
+    other. Writes replace the file atomically, so readers never see a partial
+    listing.
+    '''
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+
+    def listing_path(self, listing: str) -> str:
+        root, extension = os.path.splitext(self.path)
+        return f'{root}_{listing}{extension or ".json"}'
+
+    def _read(self, listing: str) -> Optional[dict]:
+        path = self.listing_path(listing)
+        try:
+            with open(path, encoding='utf-8') as f_handle:
+                return json.load(f_handle)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f'Ignoring unreadable catalog cache {path}. Exception: {e}')
+            return None
+
+    def _write(self, listing: str, entry: dict) -> None:
+        path = self.listing_path(listing)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f_handle:
+            json.dump(entry, f_handle, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def get(self, listing: str) -> Optional[dict]:
+        # Returns the entries of the listing by id, or None when it was never refreshed or the TTL expired
+        entry = self._read(listing)
+        if not entry or time.time() - entry.get('refreshed_at', 0) >= self.ttl_seconds:
+            return None
+        return entry['items']
+
+    def put(self, listing: str, items: dict) -> None:
+        # Stores a full refresh of the listing
+        self._write(listing, {'refreshed_at': time.time(), 'items': {str(key): value for key, value in items.items()}})
+
+    def add(self, listing: str, items: dict) -> None:
+        # Adds entries fetched one at a time. The listing keeps the time of its last full refresh
+        entry = self._read(listing)
+        if not entry:
+            return
+        entry['items'].update({str(key): value for key, value in items.items()})
+        self._write(listing, entry)
@@ -1,5 +1,18 @@
+import random
 import re
-from airflow.providers.http.hooks.http import HttpHook
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import timedelta
+from typing import Iterator, Optional
+from nr_utils.catalog_cache import CatalogCache
+from nr_utils.json_stream import iter_json_object_items
+from nr_utils.manifest_cache import ManifestCache
+from nr_utils.manifest_index import ManifestIndex, ManifestResource
+from nr_utils import rate_limit, telemetry
+
+
+_DISCOVERY_VARIABLE_PATTERN = re.compile(r'\$(jobId|runId)\b')
 
 
 def dbt_cloud_validation(responses):
@@ -38,91 +51,438 @@ def paginate_dbt_cloud_api_response(response):
             return dict(data={'offset': offset + count }) 
 
 
-def get_dbt_cloud_manifest_filtered(manifest: dict) -> dict:
-    fields = []
-    for node_id, node_data in manifest.get('nodes', {}).items():
-
-        test_model = node_data.get('test_metadata', {}).get('kwargs', {}).get('model') 
-        match = re.search(r"\'(\w+)\'", test_model) if test_model else None
-        model_name = match.group(1) if match else node_data.get('name') 
-        failed_test_rows_limit = node_data.get('config', {}).get('meta',{}).get('nr_config',{}).get('failed_test_row_limit',100)
-        
-        fields.append({
-            'resource_type': node_data.get('resource_type'),
-            'unique_id': node_data.get('unique_id'),
-            'database_name': node_data.get('database'),
-            'schema_name': node_data.get('schema'),
-            'test_column_name': node_data.get('test_metadata', {}).get('kwargs', {}).get('column_name'),
-            'test_model_name': model_name,
-            'test_namespace': node_data.get('test_metadata', {}).get('namespace'),
-            'test_parameters': node_data.get('test_metadata', {}).get('kwargs'),
-            'test_short_name': node_data.get('test_metadata', {}).get('name'),
-            'alias': node_data.get('alias'),
-            'severity': node_data.get('config', {}).get('severity'),
-            'warn_if': node_data.get('config', {}).get('warn_if'),
-            'error_if': node_data.get('config', {}).get('error_id'),
-            'tags': node_data.get('config', {}).get('tags'),
-            'path': node_data.get('path'),
-            'original_file_path': node_data.get('original_file_path'),
-            'meta': node_data.get('meta'),
-            'meta_config': node_data.get('config', {}).get('meta'),
-            'team': node_data.get('config', {}).get('meta',{}).get('nr_config',{}).get('team','Data Engineering'),
-            'alert_failed_test_rows':node_data.get('config', {}).get('meta',{}).get('nr_config',{}).get('alert_failed_test_rows',False),
-            'failed_test_row_limit': failed_test_rows_limit if failed_test_rows_limit<=100 else 100,
-            'slack_mentions': node_data.get('config', {}).get('meta',{}).get('nr_config',{}).get('slack_mentions'),
-            'message': node_data.get('config', {}).get('meta',{}).get('nr_config',{}).get('message',''),
+def get_remaining_page_offsets(response) -> list:
+    # Offsets of every page after the first one, from the total_count and limit of the first page
+    extras = response.json()['extra']
+    total_count = extras['pagination']['total_count']
+    offset = extras['filters']['offset']
+    limit = extras['filters'].get('limit') or extras['pagination']['count']
+    if not limit:
+        return []
+    return list(range(offset + limit, total_count, limit))
+
+
+def get_retries(response) -> int:
+    # Retries of a response returned by DbtCloudClient.request
+    return getattr(response, 'retries', 0)
+
+
+class DbtCloudClient:
+    '''Reusable client for the dbt Cloud admin and discovery APIs.
+
+    The Airflow connection and token are resolved once when the client is
+    created. Requests share one keep-alive session with a connection pool, so
+    a task reuses TLS connections instead of opening one per call. The client
+    is safe to share between the threads of a task. Requests go through the
+    rate limiter of rate_limit_family and 429 responses are retried after the
+    Retry-After of the response or an exponential backoff.
+    '''
+
+    def __init__(self,
+                 http_conn_id: str,
+                 pool_connections: int = 4,
+                 pool_maxsize: int = 16,
+                 timeout: int = 300,
+                 max_concurrent_pages: int = 4,
+                 rate_limit_family: str = rate_limit.ADMIN_API,
+                 max_retries: int = 5):
+        # Imported here so parsing the DAG does not load the HTTP provider
+        from airflow.providers.http.hooks.http import HttpHook
+        from requests.adapters import HTTPAdapter
+
+        http_hook = HttpHook(http_conn_id=http_conn_id, method='GET')
+        # get_conn resolves the connection, sets base_url and applies any headers in the connection extras
+        self.session = http_hook.get_conn()
+        self.base_url = http_hook.base_url
+        self.timeout = timeout
+        self.max_concurrent_pages = max_concurrent_pages
+        self.limiter = rate_limit.get_limiter(rate_limit_family)
+        self.max_retries = max_retries
+        token = http_hook.get_connection(http_conn_id).password
+        self.session.headers.update({
+            'Content-Type': "application/json",
+            'Authorization': f"Token {token}"
         })
-    return fields
-
-def get_dbt_cloud_manifest(run_id: str, http_conn_id: str) -> dict:
-    http_hook = HttpHook(http_conn_id=http_conn_id, method='GET')
-    endpoint = f'/runs/{run_id}/artifacts/manifest.json'
-    token = http_hook.get_connection(http_conn_id).password
-    headers = {
-        'Content-Type': "application/json",
-        'Authorization': f"Token {token}"
-    }
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def url(self, endpoint: str) -> str:
+        # Joins the endpoint to the connection host the same way HttpHook does
+        if self.base_url and not self.base_url.endswith('/') and endpoint and not endpoint.startswith('/'):
+            return self.base_url + '/' + endpoint
+        return (self.base_url or '') + (endpoint or '')
 
-    try:
-        
-        response = http_hook.run(endpoint=endpoint,headers=headers)
+    def request(self, method: str, endpoint: str = '', **kwargs):
+        # The number of times a request was retried is kept on the response as retries, so callers
+        # can add it to their telemetry span
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.limiter.acquire()
+            response = self.session.request(method, self.url(endpoint), **kwargs)
+            retry_after = self.limiter.observe(response.status_code, response.headers)
+            if response.status_code != 429 or attempt > self.max_retries:
+                break
+            response.close()
+            delay = retry_after if retry_after is not None else random.uniform(0, min(60, 2 ** (attempt - 1)))
+            if retry_after is None:
+                self.limiter.pause(delay)
+            print(f'dbt Cloud API rate limited {endpoint}, retrying in {delay:.1f}s (attempt {attempt}/{self.max_retries})')
+            time.sleep(delay)
+        response.retries = attempt - 1
         response.raise_for_status()
-        return response.json()
+        return response
+
+    def get(self, endpoint: str, params: dict = None, stream: bool = False):
+        return self.request('GET', endpoint, params=params, stream=stream)
+
+    def post(self, endpoint: str = '', json: dict = None):
+        return self.request('POST', endpoint, json=json)
+
+    def paginate(self, endpoint: str, params: dict = None, response_check=dbt_cloud_validation, response_filter=dbt_cloud_response_filter):
+        # Follows the offset pagination of the admin API and applies the response check and filter to all pages.
+        # The total_count of the first page gives the offsets of the other pages, which are fetched
+        # max_concurrent_pages at a time and kept in offset order.
+        params = dict(params or {})
+        with telemetry.span('admin_api_paging', endpoint=endpoint) as perf:
+            responses = [self.get(endpoint, params=params)]
+            offsets = get_remaining_page_offsets(responses[0])
+            if offsets and self.max_concurrent_pages > 1:
+                def get_page(offset):
+                    return self.get(endpoint, params={**params, 'offset': offset})
+
+                with ThreadPoolExecutor(max_workers=min(self.max_concurrent_pages, len(offsets))) as executor:
+                    responses += executor.map(get_page, offsets)
+            # Pages added after the first page was read, or every page when fetching one at a time
+            next_page = paginate_dbt_cloud_api_response(responses[-1])
+            while next_page:
+                params.update(next_page['data'])
+                responses.append(self.get(endpoint, params=params))
+                next_page = paginate_dbt_cloud_api_response(responses[-1])
+
+            if response_check and not response_check(responses):
+                raise Exception(f'Dbt cloud API returned invalid data for {endpoint}')
+            data = response_filter(responses)
+            perf.update(pages=len(responses), records=len(data), bytes=sum(len(response.content) for response in responses),
+                        retries=sum(get_retries(response) for response in responses))
+        return data
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_dbt_cloud_catalog(client: DbtCloudClient, listing: str, catalog_cache: Optional[CatalogCache] = None) -> dict:
+    # Gets the id and name of every project or environment by id. listing is 'projects' or 'environments'.
+    # The cached listing is used until its TTL expires
+    with telemetry.span('catalog', listing=listing, cache_hit=False) as perf:
+        items = catalog_cache.get(listing) if catalog_cache else None
+        if items is not None:
+            perf.update(cache_hit=True, records=len(items))
+            print(f'Using {len(items)} cached {listing}')
+            return items
+        items = client.paginate(f'/{listing}/', response_filter=dbt_cloud_secure_response_filter)
+        # Ids are strings, the same as after an XCom round trip and in the flattened runs
+        items = {str(key): value for key, value in items.items()}
+        if catalog_cache:
+            catalog_cache.put(listing, items)
+        perf.update(records=len(items))
+    return items
+
+
+def get_dbt_cloud_catalog_items(client: DbtCloudClient,
+                                listing: str,
+                                ids: set,
+                                catalog_cache: Optional[CatalogCache] = None,
+                                max_single_requests: int = 10) -> dict:
+    # Gets projects or environments that are missing from the catalog by id. Falls back to a full refresh
+    # of the listing when more than max_single_requests are missing or one of them can not be fetched
+    items = None
+    if len(ids) <= max_single_requests:
+        try:
+            items = {}
+            for item_id in ids:
+                item = client.get(f'/{listing}/{item_id}/').json()['data']
+                items[str(item['id'])] = {'id': item['id'], 'name': item['name']}
+        except Exception as e:
+            print(f'Could not get {listing} {sorted(ids)} by id, refreshing all {listing}. Exception: {e}')
+            items = None
+    if items is None:
+        # Skips the cached listing, which is still fresh but incomplete
+        items = get_dbt_cloud_catalog(client, listing)
+        if catalog_cache:
+            catalog_cache.put(listing, items)
+        return items
+    if catalog_cache:
+        catalog_cache.add(listing, items)
+    print(f'Got {len(items)} {listing} by id')
+    return items
+
+
+def get_dbt_cloud_runs(client: DbtCloudClient, finished_after, finished_before) -> list:
+    # Gets every run, with its job, that finished in the range. Both ends of the range are inclusive
+    params = {
+        'finished_at__range': f'["{finished_after}", "{finished_before}"]',
+        'include_related': ['job'],
+        'order_by': '-finished_at',
+    }
+    return client.paginate('/runs/', params, response_filter=dbt_cloud_response_filter)
+
+
+def get_dbt_cloud_runs_windowed(client: DbtCloudClient,
+                                finished_after,
+                                finished_before,
+                                window: timedelta,
+                                max_concurrency: int = 4) -> list:
+    # Splits a long range into windows and pages through the windows in parallel. Used for backfills
+    # where a single range would hold thousands of runs. Reports the throughput of every window.
+    windows = []
+    window_start = finished_after
+    while window_start < finished_before:
+        window_end = min(window_start + window, finished_before)
+        windows.append((window_start, window_end))
+        window_start = window_end
+
+    def get_window(window_range):
+        window_start, window_end = window_range
+        start = time.monotonic()
+        # Windows do not overlap, the end of each window belongs to the next one
+        runs = get_dbt_cloud_runs(client, window_start, window_end - timedelta(microseconds=1))
+        seconds = time.monotonic() - start
+        print(f'Window {window_start} - {window_end}: {len(runs)} runs in {seconds:.2f}s '
+              f'({len(runs) / seconds if seconds else 0:.1f} runs/s)')
+        return runs
+
+    runs = []
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for window_runs in executor.map(get_window, windows):
+            runs += window_runs
+    print(f'Found {len(runs)} runs in {len(windows)} windows')
+    return runs
+
 
-    except Exception as e:
-        # Some jobs do not have a manifest. if the dbt command failed
-        print(f'Could not retrieve manifest.json from dbt cloud for run_id: {run_id}. Exception: {e}')
-        return {}
+def filter_manifest_node(node_data: dict) -> dict:
+    # Keeps the fields we send to NR1 for a single manifest node
+    return ManifestResource.from_node(node_data).to_dict()
+
+
+def _count_bytes(chunks, perf: dict):
+    for chunk in chunks:
+        perf['bytes'] = perf.get('bytes', 0) + len(chunk)
+        yield chunk
+
+
+def stream_dbt_cloud_manifest_nodes(run_id: str,
+                                    client: DbtCloudClient,
+                                    chunk_size: int = 1024 * 1024,
+                                    unique_ids: Optional[set] = None,
+                                    perf: Optional[dict] = None) -> Iterator[tuple]:
+    # Reads manifest.json in chunks and yields (unique_id, node) pairs one at a time. Memory
+    # stays flat no matter how large the manifest is because the full document is never loaded.
+    # Only the nodes in unique_ids are decoded when it is given. The bytes read are added to perf.
+    # Errors are raised so callers know the manifest is incomplete.
+    response = client.get(f'/runs/{run_id}/artifacts/manifest.json', stream=True)
+    with closing(response):
+        chunks = response.iter_content(chunk_size=chunk_size)
+        if perf is not None:
+            perf['retries'] = get_retries(response)
+            chunks = _count_bytes(chunks, perf)
+        yield from iter_json_object_items(chunks, 'nodes', unique_ids)
+
+
+def get_dbt_cloud_manifest_index(run: dict,
+                                 client: DbtCloudClient,
+                                 unique_ids: Optional[set] = None,
+                                 manifest_cache: Optional[ManifestCache] = None,
+                                 streaming: bool = True,
+                                 chunk_size: int = 1024 * 1024) -> ManifestIndex:
+    # Returns the manifest of an enriched run indexed by unique_id. Nodes are only filtered when
+    # they are looked up, and a streamed manifest only decodes the nodes in unique_ids.
+    # Runs of the same job and environment at the same git sha share a manifest, so when the
+    # run can be cached the whole project is filtered once, node by node as it streams in, and
+    # reused by the following runs.
+    run_id = run['run_id']
+    with telemetry.span('manifest', run_id=run_id, streaming=streaming, cache_hit=False) as perf:
+        cache_key = None
+        if manifest_cache:
+            cache_key = manifest_cache.cache_key(run['job_id'], run['environment_id'], run.get('run_git_sha'))
+        if cache_key:
+            cached = manifest_cache.get(cache_key)
+            if cached is not None:
+                print(f'Using cached manifest for run_id: {run_id}')
+                perf.update(cache_hit=True, records=len(cached))
+                return ManifestIndex.from_records(cached)
+            # The cache entry is used by later runs that may have run other resources
+            unique_ids = None
+
+        try:
+            if streaming:
+                nodes = stream_dbt_cloud_manifest_nodes(run_id, client, chunk_size=chunk_size,
+                                                        unique_ids=unique_ids, perf=perf)
+            else:
+                nodes = get_dbt_cloud_manifest(run_id, client, perf=perf).get('nodes', {}).items()
+            if cache_key:
+                # Nodes are filtered as they stream in, so only one raw node is held at a time
+                manifest_filtered = [filter_manifest_node(node_data) for _unique_id, node_data in nodes]
+            else:
+                nodes = dict(nodes)
+        except Exception as e:
+            # Some jobs do not have a manifest. if the dbt command failed. Any other error, such as
+            # a manifest that can not be parsed, fails the run instead of dropping its resource runs
+            if getattr(getattr(e, 'response', None), 'status_code', None) != 404:
+                raise
+            print(f'Could not retrieve manifest.json from dbt cloud for run_id: {run_id}. Exception: {e}')
+            perf.update(status='error', error=str(e)[:1000])
+            return ManifestIndex({})
+
+        if cache_key:
+            perf['records'] = len(manifest_filtered)
+            if manifest_filtered:
+                manifest_cache.put(cache_key, manifest_filtered)
+            return ManifestIndex.from_records(manifest_filtered)
+        perf['records'] = len(nodes)
+        return ManifestIndex.from_nodes(nodes)
+
+
+def get_dbt_cloud_manifest(run_id: str, client: DbtCloudClient, perf: Optional[dict] = None) -> dict:
+    # Downloads and parses the whole manifest.json. Errors are raised, the same as when streaming
+    response = client.get(f'/runs/{run_id}/artifacts/manifest.json')
+    if perf is not None:
+        perf.update(bytes=len(response.content), retries=get_retries(response))
+    return response.json()
+
+
+def build_dbt_discovery_document(query_list: list, run_count: int = 1) -> str:
+    # Merges every discovery query for one or more runs into a single GraphQL document.
+    # Each run gets its own $jobId_N/$runId_N variables and every field is aliased as
+    # rN_<resource_type> so the response can be split back per run.
+    variable_definitions = []
+    fields = []
+    for index in range(run_count):
+        variable_definitions.append(f'$jobId_{index}: Int!, $runId_{index}: Int')
+        for query in query_list:
+            query_text = _DISCOVERY_VARIABLE_PATTERN.sub(lambda match: f'{match.group(0)}_{index}', query['query'].strip())
+            fields.append(f"r{index}_{query['resource_type']}: {query_text}")
+    fields_body = '\n'.join(fields)
+    return f"""
+                    query dbtObjects({', '.join(variable_definitions)}) {{
+                    {fields_body}
+                    }}"""
+
+
+def get_dbt_cloud_run_results_batch(runs: list,
+                                    client: DbtCloudClient,
+                                    query_list) -> dict:
+    # Gets the discovery API results for a list of (job_id, run_id) pairs with one request.
+    # Returns a dict of run_id to status dict in the same shape as get_dbt_cloud_run_results
+    query_body = build_dbt_discovery_document(query_list, len(runs))
+    variables = {}
+    for index, (dbt_job_id, dbt_run_id) in enumerate(runs):
+        variables[f'jobId_{index}'] = int(dbt_job_id)
+        variables[f'runId_{index}'] = int(dbt_run_id)
+
+    with telemetry.span('discovery_query', runs=len(runs)) as perf:
+        response = client.post(json={"query": query_body, "variables": variables})
+
+        if response.status_code != 200 or not dbt_cloud_validation([response]):
+            raise Exception('Dbt cloud Discovery API returned invalid data')
+
+        data = response.json()['data'] or {}
+        results = {}
+        for index, (_dbt_job_id, dbt_run_id) in enumerate(runs):
+            status_dict = {}
+            for query in query_list:
+                alias = f"r{index}_{query['resource_type']}"
+                if alias not in data:
+                    raise Exception('Dbt cloud Discovery API returned invalid data')
+                status_dict[query['resource_type']] = data[alias]
+            results[dbt_run_id] = status_dict
+        perf.update(bytes=len(response.content), retries=get_retries(response),
+                    records=sum(len(statuses or []) for status_dict in results.values() for statuses in status_dict.values()))
+
+    return results
 
 
 def get_dbt_cloud_run_results(dbt_job_id: str, 
                               dbt_run_id: str, 
-                              http_conn_id: str,
+                              client: DbtCloudClient,
                               query_list) -> dict:
-    # query_list = read_config('dbt_discovery_queries.yml')
-    json_data_dict ={}
+    # All discovery queries for the run are sent as one aliased document
+    return get_dbt_cloud_run_results_batch([(dbt_job_id, dbt_run_id)], client, query_list)[dbt_run_id]
+
+
+def split_discovery_queries(query_list: list) -> tuple:
+    # Removes the heavy_fields of each query for two phase discovery. Returns the light query list
+    # and the detail queries, by resource type, that fetch the heavy fields of a single resource
+    light_query_list = []
+    detail_queries = {}
     for query in query_list:
-        query_body = f"""
-                    query dbtObjects($jobId: Int!, $runId: Int) {{
-                    {query['query']}   
-                    }}"""
-        variables = {
-                "jobId": int(dbt_job_id),
-                "runId": int(dbt_run_id)
+        heavy_fields = query.get('heavy_fields') or []
+        if not heavy_fields or not query.get('single_resource'):
+            light_query_list.append(query)
+            continue
+        # Matches "alias: fieldName" or a bare field name, but not the value side of another alias
+        field_pattern = re.compile(
+            r'(?<![\w$])(?<!:\s)(?:' + '|'.join(map(re.escape, heavy_fields)) + r')\b(?:\s*:\s*\w+)?')
+        selections = field_pattern.findall(query['query'])
+        light_query_list.append(dict(query, query=field_pattern.sub('', query['query'])))
+        if selections:
+            detail_queries[query['resource_type']] = {
+                'single_resource': query['single_resource'],
+                'selection': ' '.join(selections),
             }
-        
-
-        http_hook = HttpHook(method='POST', http_conn_id=http_conn_id)
-        api_key = http_hook.get_connection(http_conn_id).password
-        headers = {
-        'Authorization': f"Token {api_key}",
-        'Content-Type': 'application/json'
-        }
-        response = http_hook.run(json={"query": query_body, "variables": variables}, headers=headers) 
-
-        if response.status_code == 200  and dbt_cloud_validation([response]) and query['resource_type'] in response.json()['data']:
-            json_data_dict.update(response.json()['data'])
-        else:
-            raise Exception('Dbt cloud Discovery API returned invalid data')
+    return light_query_list, detail_queries
+
+
+def build_dbt_discovery_detail_document(resources: list, detail_queries: dict) -> str:
+    # Builds one aliased single resource query (model, test, seed, snapshot) per (resource_type, unique_id)
+    variable_definitions = ['$jobId: Int!', '$runId: Int']
+    fields = []
+    for index, (resource_type, _unique_id) in enumerate(resources):
+        detail_query = detail_queries[resource_type]
+        variable_definitions.append(f'$u{index}: String!')
+        fields.append(f"u{index}: {detail_query['single_resource']}(jobId: $jobId, runId: $runId, uniqueId: $u{index}) "
+                      f"{{ unique_id: uniqueId {detail_query['selection']} }}")
+    fields_body = '\n'.join(fields)
+    return f"""
+                    query dbtResourceDetails({', '.join(variable_definitions)}) {{
+                    {fields_body}
+                    }}"""
+
+
+def get_dbt_cloud_resource_details(dbt_job_id: str,
+                                   dbt_run_id: str,
+                                   resources: list,
+                                   client: DbtCloudClient,
+                                   detail_queries: dict,
+                                   resources_per_request: int = 100) -> dict:
+    # Second phase of two phase discovery. Gets the heavy fields of the (resource_type, unique_id)
+    # pairs of a run. Returns a dict of unique_id to the heavy field values
+    details = {}
+    for start in range(0, len(resources), resources_per_request):
+        chunk = resources[start:start + resources_per_request]
+        variables = {'jobId': int(dbt_job_id), 'runId': int(dbt_run_id)}
+        for index, (_resource_type, unique_id) in enumerate(chunk):
+            variables[f'u{index}'] = unique_id
+
+        with telemetry.span('discovery_detail_query', run_id=str(dbt_run_id), records=len(chunk)) as perf:
+            response = client.post(json={"query": build_dbt_discovery_detail_document(chunk, detail_queries),
+                                          "variables": variables})
+            if response.status_code != 200 or not dbt_cloud_validation([response]):
+                raise Exception('Dbt cloud Discovery API returned invalid data')
+            perf.update(bytes=len(response.content), retries=get_retries(response))
 
-    return json_data_dict
\ No newline at end of file
+        data = response.json()['data'] or {}
+        for index, (_resource_type, unique_id) in enumerate(chunk):
+            detail = data.get(f'u{index}')
+            if detail:
+                detail.pop('unique_id', None)
+                details[unique_id] = detail
+    return details
@@ -1,95 +1,239 @@
 import asyncio
-import inspect
+import gzip
+import json
 import logging
-from airflow.providers.http.hooks.http import HttpAsyncHook
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterator, Optional, Tuple
+
+from nr_utils import rate_limit, telemetry
+
+# aiohttp and the HTTP provider are imported where they are used, so parsing the DAG does not load them
+if TYPE_CHECKING:
+    import aiohttp
 
 log = logging.getLogger(__name__)
 
+# The Event API rejects payloads larger than 1MB after compression
+MAX_PAYLOAD_BYTES = 1_000_000
+
 
-async def run_in_loop(hook, data, headers):
-    """Run a single async HTTP request using the provided hook.
+def pack_batches(records: list,
+                 max_records: int = 500,
+                 max_batch_bytes: int = 5_000_000,
+                 max_payload_bytes: int = MAX_PAYLOAD_BYTES,
+                 compresslevel: int = 6) -> Iterator[Tuple[bytes, int, int]]:
+    """Pack records into gzipped JSON payloads sized for the Event API.
 
-    This inspects the hook.run signature to decide whether to send the payload
-    as `json=` or `data=` so it works across provider versions.
-    Returns a tuple of (status, response_text).
+    Records are serialized once and grouped until a batch reaches max_records or
+    max_batch_bytes of uncompressed JSON. A batch that still compresses past
+    max_payload_bytes is split in half until every part fits.
+
+    Yields:
+        Tuples of (gzipped payload, record count, uncompressed bytes).
     """
-    try:
-        sig = inspect.signature(hook.run)
-        params = sig.parameters
-        kwargs = {"headers": headers, "extra_options": {"compress": True}}
-        if 'json' in params:
-            kwargs['json'] = data
-        else:
-            kwargs['data'] = data
-
-        response = await hook.run(**kwargs)
-        # aiohttp-like responses have .status and .text()
-        status = getattr(response, 'status', None) or getattr(response, 'status_code', None)
-        text = await response.text()
-        return status, text
-    except Exception as exc:
-        log.exception('Error running async upload: %s', exc)
-        raise
-
-
-def upload_data(records: list, http_conn_id: str, chunk_size=100) -> None:
-    """Upload records to New Relic in chunks using an async HTTP hook.
+    def compress(parts):
+        raw = b'[' + b','.join(parts) + b']'
+        payload = gzip.compress(raw, compresslevel=compresslevel)
+        if len(payload) > max_payload_bytes and len(parts) > 1:
+            middle = len(parts) // 2
+            yield from compress(parts[:middle])
+            yield from compress(parts[middle:])
+            return
+        if len(payload) > max_payload_bytes:
+            log.warning('A single record compresses to %d bytes which is above the %d byte payload limit',
+                        len(payload), max_payload_bytes)
+        yield payload, len(parts), len(raw)
 
-    Args:
-        records: list of record dicts to send. Each record should contain an "eventType".
-        http_conn_id: Airflow HTTP connection id to use for the POST requests.
-        chunk_size: number of records per request.
+    parts = []
+    batch_bytes = 0
+    for record in records:
+        part = json.dumps(record, separators=(',', ':'), default=str).encode('utf-8')
+        if parts and (len(parts) >= max_records or batch_bytes + len(part) > max_batch_bytes):
+            yield from compress(parts)
+            parts = []
+            batch_bytes = 0
+        parts.append(part)
+        batch_bytes += len(part) + 1
+    if parts:
+        yield from compress(parts)
+
+
+async def post_batch(session: 'aiohttp.ClientSession',
+                     url: str,
+                     headers: dict,
+                     batch: Tuple[bytes, int, int],
+                     semaphore: asyncio.Semaphore,
+                     max_retries: int = 5,
+                     backoff: float = 1.0,
+                     max_backoff: float = 60.0,
+                     rate_limit_family: str = rate_limit.EVENT_API) -> dict:
+    """Send one pre-compressed batch, retrying 429 and 5xx responses.
+
+    Retries wait for the Retry-After header when present, otherwise for an
+    exponential backoff with full jitter. The semaphore is only held while a
+    request is in flight so waiting retries do not block other batches. Every
+    request takes a token from the rate limiter of rate_limit_family, and a 429
+    pauses the family for all batches instead of only this one.
+
+    Returns:
+        A dict with the status, record count, bytes, attempts and latency of the batch.
     """
-    if not records:
-        log.debug('No records to upload')
-        return
+    import aiohttp
 
-    hook = HttpAsyncHook(method='POST', http_conn_id=http_conn_id)
-    # Use the same connection id provided to the function to retrieve the API key.
-    try:
-        conn = hook.get_connection(http_conn_id)
-    except Exception:
-        # Fallback to BaseHook behavior if necessary
-        conn = hook.get_connection(http_conn_id)
+    limiter = rate_limit.get_limiter(rate_limit_family)
+    payload, record_count, raw_bytes = batch
+    attempt = 0
+    started_at = time.time()
+    first_start = time.monotonic()
+    while True:
+        attempt += 1
+        retry_after = None
+        # Wait for the rate limiter before taking a slot, so waiting batches do not hold the semaphore
+        await limiter.acquire_async()
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                async with session.post(url, data=payload, headers=headers) as response:
+                    status = response.status
+                    body = await response.text()
+                    retry_after = limiter.observe(status, response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                status, body = None, str(exc)
+            latency = time.monotonic() - start
+
+        stats = {
+            'status': status,
+            'records': record_count,
+            'bytes': raw_bytes,
+            'compressed_bytes': len(payload),
+            'attempts': attempt,
+            'latency': latency,
+        }
+        if status is not None and 200 <= status < 300:
+            log.info('NR upload batch status=%s records=%d bytes=%d compressed_bytes=%d attempts=%d latency=%.3fs',
+                     status, record_count, raw_bytes, len(payload), attempt, latency)
+            telemetry.record_span('upload_batch', started_at, time.monotonic() - first_start, status='success',
+                                  http_status=status, records=record_count, bytes=raw_bytes,
+                                  compressed_bytes=len(payload), retries=attempt - 1, latency=latency)
+            return stats
+
+        retryable = status is None or status == 429 or status >= 500
+        if not retryable or attempt > max_retries:
+            telemetry.record_span('upload_batch', started_at, time.monotonic() - first_start, status='error',
+                                  http_status=status, records=record_count, bytes=raw_bytes,
+                                  compressed_bytes=len(payload), retries=attempt - 1, latency=latency)
+            raise RuntimeError(f'NR upload failed status={status} records={record_count} attempts={attempt} '
+                               f'body={body[:200] if isinstance(body, str) else body}')
+
+        delay = retry_after if retry_after is not None else random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1)))
+        if status == 429 and retry_after is None:
+            limiter.pause(delay)
+        log.warning('NR upload batch status=%s, retrying in %.1fs (attempt %d/%d)', status, delay, attempt, max_retries)
+        await asyncio.sleep(delay)
+
+
+async def upload_batches(batches, url: str, headers: dict, max_concurrency: int = 4, max_retries: int = 5, timeout: int = 120) -> list:
+    # Sends the batches with at most max_concurrency requests in flight. Every batch is attempted
+    # before the first failure is raised
+    import aiohttp
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        results = await asyncio.gather(
+            *(post_batch(session, url, headers, batch, semaphore, max_retries=max_retries) for batch in batches),
+            return_exceptions=True)
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    for error in errors:
+        log.error('NR upload batch failed: %s', error)
+    if errors:
+        raise errors[0]
+    return results
 
-    api_key = getattr(conn, 'password', None)
+
+def get_upload_target(http_conn_id: str) -> Tuple[str, dict]:
+    # Resolves the Event API url and headers from the Airflow connection
+    from airflow.providers.http.hooks.http import HttpHook
+
+    hook = HttpHook(method='POST', http_conn_id=http_conn_id)
+    # get_conn builds base_url from the connection the same way HttpHook requests do
+    hook.get_conn().close()
+    api_key = getattr(hook.get_connection(http_conn_id), 'password', None)
     if not api_key:
         log.error('No API key found in connection %s', http_conn_id)
         raise RuntimeError(f'No API key found in connection {http_conn_id}')
 
-    headers = {"Api-Key": api_key, "Content-Type": "application/json"}
+    headers = {"Api-Key": api_key, "Content-Type": "application/json", "Content-Encoding": "gzip"}
+    return hook.base_url, headers
+
+
+async def upload_data_async(records: list,
+                            http_conn_id: str,
+                            chunk_size=100,
+                            max_batch_bytes: int = 5_000_000,
+                            max_payload_bytes: int = MAX_PAYLOAD_BYTES,
+                            max_concurrency: int = 4,
+                            max_retries: int = 5,
+                            target: Optional[Tuple[str, dict]] = None) -> list:
+    """Awaitable version of upload_data.
+
+    Args:
+        target: (url, headers) from get_upload_target. Pass it in when uploading many
+            times from the same task to skip the connection lookup.
+
+    See upload_data for the other arguments.
+    """
+    if not records:
+        log.debug('No records to upload')
+        return []
+
+    # Connection lookups and compression are blocking, so they run outside the event loop
+    url, headers = target or await asyncio.to_thread(get_upload_target, http_conn_id)
+    batches = await asyncio.to_thread(
+        lambda: list(pack_batches(records, max_records=chunk_size, max_batch_bytes=max_batch_bytes,
+                                  max_payload_bytes=max_payload_bytes)))
+    event_type = records[0].get('eventType', 'unknown') if isinstance(records[0], dict) else 'unknown'
+    log.info('Sending %d records in %d batches (%d compressed bytes) for eventType: %s',
+             len(records), len(batches), sum(len(batch[0]) for batch in batches), event_type)
+
+    return await upload_batches(batches, url, headers, max_concurrency=max_concurrency, max_retries=max_retries)
 
-    tasks = []
-    for chunk_start in range(0, len(records), chunk_size):
-        chunk_records = records[chunk_start:chunk_start + chunk_size]
-        try:
-            event_type = chunk_records[0].get('eventType') if chunk_records else 'unknown'
-        except Exception:
-            event_type = 'unknown'
-        log.info('Sending chunk %d..%d (%d records) for eventType: %s',
-                 chunk_start, chunk_start + len(chunk_records) - 1, len(chunk_records), event_type)
-        tasks.append(run_in_loop(hook, chunk_records, headers))
 
-    # Ensure we have an event loop available. Create one if needed.
+def upload_data(records: list,
+                http_conn_id: str,
+                chunk_size=100,
+                max_batch_bytes: int = 5_000_000,
+                max_payload_bytes: int = MAX_PAYLOAD_BYTES,
+                max_concurrency: int = 4,
+                max_retries: int = 5) -> list:
+    """Upload records to New Relic in gzipped batches.
+
+    Args:
+        records: list of record dicts to send. Each record should contain an "eventType".
+        http_conn_id: Airflow HTTP connection id to use for the POST requests.
+        chunk_size: maximum number of records per request.
+        max_batch_bytes: maximum uncompressed JSON bytes per request.
+        max_payload_bytes: maximum gzipped bytes per request.
+        max_concurrency: maximum number of requests in flight.
+        max_retries: number of retries for 429 and 5xx responses.
+
+    Returns:
+        A list with the stats of every batch sent.
+    """
+    if not records:
+        log.debug('No records to upload')
+        return []
+
+    upload = upload_data_async(records, http_conn_id, chunk_size=chunk_size, max_batch_bytes=max_batch_bytes,
+                               max_payload_bytes=max_payload_bytes, max_concurrency=max_concurrency,
+                               max_retries=max_retries)
     try:
-        loop = asyncio.get_event_loop()
+        asyncio.get_running_loop()
     except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-    # If the loop is already running (rare in Airflow workers), run tasks synchronously
-    if loop.is_running():
-        # Fall back to running each task sequentially via asyncio.run in a new loop
-        results = []
-        for t in tasks:
-            try:
-                results.append(asyncio.run(t))
-            except Exception as exc:
-                log.exception('Async chunk upload failed: %s', exc)
-                results.append((None, str(exc)))
-    else:
-        results = loop.run_until_complete(asyncio.gather(*tasks))
-
-    # Log results summary
-    for status, body in results:
-        log.info('NR upload result status=%s body=%s', status, (body[:200] + '...') if isinstance(body, str) and len(body) > 200 else body)
\ No newline at end of file
+        return asyncio.run(upload)
+
+    # Called from inside a running event loop (rare in Airflow workers). Run the upload on its own loop in a thread
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, upload).result()
@@ -0,0 +1,131 @@
+import codecs
+import json
+from typing import Iterable, Iterator, Optional, Tuple
+
+
+_WHITESPACE = ' \t\n\r'
+# Characters that can follow a complete value
+_DELIMITERS = _WHITESPACE + ',:]}'
+_decoder = json.JSONDecoder()
+
+
+class JsonStreamReader:
+    '''Incremental reader for a JSON document delivered in chunks.
+
+    Only one value is ever held in memory at a time, so the cost of reading a
+    document depends on its largest entry instead of its total size.
+    '''
+
+    def __init__(self, chunks: Iterable, compact_size: int = 1024 * 1024):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._consumed = 0
+        self._eof = False
+        self._compact_size = compact_size
+
+    def _fill(self) -> bool:
+        # Read the next chunk into the buffer. Returns False once the stream is exhausted
+        if self._eof:
+            return False
+        if self._pos > self._compact_size:
+            self._buffer = self._buffer[self._pos:]
+            self._consumed += self._pos
+            self._pos = 0
+        for chunk in self._chunks:
+            text = self._utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if text:
+                self._buffer += text
+                return True
+        self._buffer += self._utf8.decode(b'', final=True)
+        self._eof = True
+        return False
+
+    def _peek(self) -> str:
+        # Returns the next non whitespace character without consuming it
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON stream')
+
+    def _expect(self, char: str) -> None:
+        if self._peek() != char:
+            raise ValueError(f'Expected {char!r} at position {self._pos} of JSON stream')
+        self._pos += 1
+
+    def read_value(self):
+        # Decodes the next complete value, reading more chunks until it is available
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number is only complete once a delimiter follows it. raw_decode stops early at
+            # the end of the buffer and also at a trailing '.', 'e' or '-' of a number cut in two
+            if (end == len(self._buffer) or self._buffer[end] not in _DELIMITERS) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def iter_object(self) -> Iterator[Tuple[str, 'JsonStreamReader']]:
+        '''Iterates over the keys of the next object in the stream.
+
+        For every key the reader itself is yielded, positioned at the value. The
+        caller must consume the value with read_value or iter_object before
+        advancing, otherwise the value is decoded and discarded.
+        '''
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(':')
+            self._peek()
+            start = self._consumed + self._pos
+            yield key, self
+            if self._consumed + self._pos == start:
+                self.skip_value()
+            if self._peek() == ',':
+                self._pos += 1
+                continue
+            self._expect('}')
+            return
+
+    def skip_value(self) -> None:
+        # Objects are skipped entry by entry so large sections never sit in memory at once
+        if self._peek() == '{':
+            for _key, _value in self.iter_object():
+                pass
+        else:
+            self.read_value()
+
+    def peek_type(self) -> str:
+        return self._peek()
+
+
+def iter_json_object_items(chunks: Iterable, key: str, item_keys: Optional[set] = None) -> Iterator[Tuple[str, object]]:
+    '''Yields (key, value) pairs of one top level object member of a chunked JSON document.
+
+    For instance iter_json_object_items(chunks, 'nodes') yields each node of a
+    dbt manifest.json without loading the rest of the manifest. When item_keys
+    is given, only those items are yielded and the others are skipped.
+    '''
+    reader = JsonStreamReader(chunks)
+    for top_level_key, value_reader in reader.iter_object():
+        if top_level_key != key:
+            continue
+        if value_reader.peek_type() != '{':
+            value_reader.skip_value()
+            continue
+        for item_key, item_reader in value_reader.iter_object():
+            if item_keys is not None and item_key not in item_keys:
+                continue
+            yield item_key, item_reader.read_value()
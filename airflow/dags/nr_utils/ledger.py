@@ -0,0 +1,105 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+
+# Event families recorded in the ledger
+JOB_RUN = 'dbt_job_run'
+RESOURCE_RUN = 'dbt_resource_run'
+FAILED_TEST_ROW = 'dbt_failed_test_row'
+# Recorded by definition_id instead of run_id
+RESOURCE_DEFINITION = 'dbt_resource_definition'
+
+# SQLite limits the number of bound parameters per statement
+_MAX_PARAMETERS = 500
+
+
+class RunLedger:
+    '''Local SQLite record of the event families successfully uploaded for each run_id.
+
+    Checking a run is an indexed lookup and does not depend on New Relic
+    ingest lag. Every call opens its own connection, so a ledger can be shared
+    between threads and tasks. Workers must see the same file for deduplication
+    to work across tasks. The file uses WAL mode and must not be on a network
+    filesystem.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('pragma journal_mode=wal')
+        conn.execute('''
+            create table if not exists uploaded_runs (
+                run_id text not null,
+                family text not null,
+                uploaded_at real not null,
+                primary key (family, run_id)
+            ) without rowid''')
+        conn.execute('create index if not exists uploaded_runs_uploaded_at on uploaded_runs (uploaded_at)')
+        # Failed tests found for a run, so a retried task does not fetch a run again only to find them
+        conn.execute('''
+            create table if not exists run_failed_tests (
+                run_id text primary key,
+                failed_tests text not null,
+                recorded_at real not null
+            ) without rowid''')
+        return conn
+
+    def uploaded_run_ids(self, family: str, run_ids: list) -> set:
+        # Returns the subset of run_ids that were already uploaded for the event family
+        run_ids = [str(run_id) for run_id in run_ids]
+        uploaded = set()
+        with closing(self._connect()) as conn:
+            for start in range(0, len(run_ids), _MAX_PARAMETERS):
+                chunk = run_ids[start:start + _MAX_PARAMETERS]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f'select run_id from uploaded_runs where family = ? and run_id in ({placeholders})',
+                    [family] + chunk)
+                uploaded.update(row[0] for row in rows)
+        return uploaded
+
+    def mark_uploaded(self, family: str, run_ids) -> None:
+        now = time.time()
+        rows = [(str(run_id), family, now) for run_id in set(run_ids)]
+        if not rows:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('insert or replace into uploaded_runs (run_id, family, uploaded_at) values (?, ?, ?)', rows)
+
+    def record_failed_tests(self, run_failed_tests: dict) -> None:
+        # Stores the failed tests of each run by run_id. Runs without failed tests are stored with an empty list
+        now = time.time()
+        rows = [(str(run_id), json.dumps(tests, separators=(',', ':'), default=str), now)
+                for run_id, tests in run_failed_tests.items()]
+        if not rows:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('insert or replace into run_failed_tests (run_id, failed_tests, recorded_at) values (?, ?, ?)', rows)
+
+    def failed_tests(self, run_ids: list) -> dict:
+        # Returns the recorded failed tests by run_id. Runs that were never recorded are left out
+        run_ids = [str(run_id) for run_id in run_ids]
+        failed_tests = {}
+        with closing(self._connect()) as conn:
+            for start in range(0, len(run_ids), _MAX_PARAMETERS):
+                chunk = run_ids[start:start + _MAX_PARAMETERS]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f'select run_id, failed_tests from run_failed_tests where run_id in ({placeholders})', chunk)
+                failed_tests.update((run_id, json.loads(tests)) for run_id, tests in rows)
+        return failed_tests
+
+    def prune(self, retention_days: float) -> None:
+        # Runs only show up in one data interval, so old entries are no longer needed
+        cutoff = time.time() - retention_days * 24 * 3600
+        with closing(self._connect()) as conn, conn:
+            conn.execute('delete from uploaded_runs where uploaded_at < ?', (cutoff,))
+            conn.execute('delete from run_failed_tests where recorded_at < ?', (cutoff,))
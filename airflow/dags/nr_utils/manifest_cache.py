@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+import json
+import os
+import uuid
+from typing import Optional
+
+
+class ManifestCache:
+    '''Size bounded LRU cache for filtered manifests on local disk.
+
+    Entries are keyed by job, environment and a fingerprint of the project
+    (the git sha of the run) so a run against an unchanged project reuses the
+    filtered manifest of an earlier run. Entries are stored as gzipped JSON and
+    the least recently used files are evicted once max_bytes is exceeded.
+    '''
+
+    suffix = '.json.gz'
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def cache_key(job_id: str, environment_id: str, fingerprint: str) -> Optional[str]:
+        # Runs without a fingerprint can not be cached. Flattened runs store missing values as 'None'
+        if not fingerprint or fingerprint == 'None':
+            return None
+        raw_key = f'{job_id}:{environment_id}:{fingerprint}'
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key: str) -> Optional[list]:
+        path = self._path(key)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f_handle:
+                records = json.load(f_handle)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f'Removing unreadable manifest cache entry {path}. Exception: {e}')
+            self._remove(path)
+            return None
+        # Touch the file so eviction treats it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return records
+
+    def put(self, key: str, records: list) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f_handle:
+            json.dump(records, f_handle, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        total_bytes = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+
+        for _mtime, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import re
+from typing import Callable, Iterable, Optional
+
+
+_TEST_MODEL_PATTERN = re.compile(r"\'(\w+)\'")
+
+
+class ManifestResource:
+    '''Fields of a single manifest node that are sent to NR1.'''
+
+    __slots__ = (
+        'resource_type',
+        'unique_id',
+        'database_name',
+        'schema_name',
+        'test_column_name',
+        'test_model_name',
+        'test_namespace',
+        'test_parameters',
+        'test_short_name',
+        'alias',
+        'severity',
+        'warn_if',
+        'error_if',
+        'tags',
+        'path',
+        'original_file_path',
+        'meta',
+        'meta_config',
+        'team',
+        'alert_failed_test_rows',
+        'failed_test_row_limit',
+        'slack_mentions',
+        'message',
+    )
+
+    @classmethod
+    def from_node(cls, node_data: dict) -> 'ManifestResource':
+        # Reads the nested config and test metadata once instead of once per field
+        resource = cls()
+        config = node_data.get('config', {})
+        meta_config = config.get('meta', {})
+        nr_config = meta_config.get('nr_config', {})
+        test_metadata = node_data.get('test_metadata', {})
+        test_kwargs = test_metadata.get('kwargs', {})
+
+        test_model = test_kwargs.get('model')
+        match = _TEST_MODEL_PATTERN.search(test_model) if test_model else None
+        failed_test_rows_limit = nr_config.get('failed_test_row_limit', 100)
+
+        resource.resource_type = node_data.get('resource_type')
+        resource.unique_id = node_data.get('unique_id')
+        resource.database_name = node_data.get('database')
+        resource.schema_name = node_data.get('schema')
+        resource.test_column_name = test_kwargs.get('column_name')
+        resource.test_model_name = match.group(1) if match else node_data.get('name')
+        resource.test_namespace = test_metadata.get('namespace')
+        resource.test_parameters = test_metadata.get('kwargs')
+        resource.test_short_name = test_metadata.get('name')
+        resource.alias = node_data.get('alias')
+        resource.severity = config.get('severity')
+        resource.warn_if = config.get('warn_if')
+        resource.error_if = config.get('error_id')
+        resource.tags = config.get('tags')
+        resource.path = node_data.get('path')
+        resource.original_file_path = node_data.get('original_file_path')
+        resource.meta = node_data.get('meta')
+        resource.meta_config = config.get('meta')
+        resource.team = nr_config.get('team', 'Data Engineering')
+        resource.alert_failed_test_rows = nr_config.get('alert_failed_test_rows', False)
+        resource.failed_test_row_limit = failed_test_rows_limit if failed_test_rows_limit <= 100 else 100
+        resource.slack_mentions = nr_config.get('slack_mentions')
+        resource.message = nr_config.get('message', '')
+        return resource
+
+    @classmethod
+    def from_dict(cls, record: dict) -> 'ManifestResource':
+        # Rebuilds a resource from to_dict output, for instance a manifest cache entry
+        resource = cls()
+        for field in cls.__slots__:
+            setattr(resource, field, record.get(field))
+        return resource
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def definition_id(self) -> str:
+        # Hash of the resource fields. Runs that share a definition share the id, even across git shas
+        serialized = json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:32]
+
+
+class ManifestIndex:
+    '''Lookup of manifest resources by unique_id that only filters the nodes that are used.
+
+    Entries are kept in their original form (raw manifest nodes or cached
+    records) and turned into a ManifestResource the first time they are looked
+    up, so the work done depends on the resources in the run instead of the
+    size of the project.
+    '''
+
+    __slots__ = ('_entries', '_materialize', '_resources', '_definition_ids')
+
+    def __init__(self, entries: dict, materialize: Callable[[dict], ManifestResource] = ManifestResource.from_node):
+        self._entries = entries
+        self._materialize = materialize
+        self._resources = {}
+        self._definition_ids = {}
+
+    @classmethod
+    def from_nodes(cls, nodes: dict) -> 'ManifestIndex':
+        # nodes is the "nodes" member of manifest.json, keyed by unique_id
+        return cls(nodes)
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict]) -> 'ManifestIndex':
+        return cls({record['unique_id']: record for record in records}, ManifestResource.from_dict)
+
+    def get(self, unique_id: str) -> Optional[ManifestResource]:
+        resource = self._resources.get(unique_id)
+        if resource is None:
+            entry = self._entries.get(unique_id)
+            if entry is None:
+                return None
+            resource = self._resources[unique_id] = self._materialize(entry)
+        return resource
+
+    def definition_id(self, unique_id: str) -> Optional[str]:
+        definition_id = self._definition_ids.get(unique_id)
+        if definition_id is None:
+            resource = self.get(unique_id)
+            if resource is None:
+                return None
+            definition_id = self._definition_ids[unique_id] = resource.definition_id()
+        return definition_id
+
+    def __contains__(self, unique_id: str) -> bool:
+        return unique_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,72 @@
+import random
+import time
+
+from nr_utils import rate_limit, telemetry
+
+
+def build_nrql_document(aliases: list) -> str:
+    # One aliased nrql field per query so every query runs in the same NerdGraph request
+    variables = ''.join(f',${alias}:String!' for alias in aliases)
+    fields = ' '.join(f'{alias}: nrql(query:${alias}){{ results }}' for alias in aliases)
+    return f'query($accountId:Int!{variables}){{ actor{{ account(id:$accountId){{ {fields} }} }} }}'
+
+
+def run_rate_limited(http_hook, request: dict, max_retries: int = 5):
+    # Sends a NerdGraph request through the NerdGraph rate limiter and retries it when it is
+    # rate limited, after the Retry-After of the response or an exponential backoff. The number of
+    # retries is kept on the response as retries
+    limiter = rate_limit.get_limiter(rate_limit.NERDGRAPH)
+    attempt = 0
+    while True:
+        attempt += 1
+        limiter.acquire()
+        response = http_hook.run(**request, extra_options={'check_response': False})
+        retry_after = limiter.observe(response.status_code, response.headers)
+        if response.status_code != 429 or attempt > max_retries:
+            break
+        delay = retry_after if retry_after is not None else random.uniform(0, min(60, 2 ** (attempt - 1)))
+        if retry_after is None:
+            limiter.pause(delay)
+        print(f'NerdGraph rate limited, retrying in {delay:.1f}s (attempt {attempt}/{max_retries})')
+        time.sleep(delay)
+    response.retries = attempt - 1
+    http_hook.check_response(response)
+    return response
+
+
+def get_nrql_unique_run_ids(queries: dict, http_conn_id: str, account_id: int, queries_per_request: int = 10) -> dict:
+    # Runs a set of "select uniques(run_id)" NRQL queries with as few NerdGraph requests as possible.
+    # Large sets are paged through, queries_per_request at a time. Returns a dict with the run ids
+    # found by each query, using the same keys as queries
+    if not queries:
+        return {}
+
+    from airflow.providers.http.hooks.http import HttpHook
+
+    http_hook = HttpHook(method='POST', http_conn_id=http_conn_id)
+    api_key = http_hook.get_connection(http_conn_id).password
+    headers = {
+        'Content-Type': 'application/json',
+        'API-Key': api_key,
+    }
+    names = list(queries)
+    run_ids = {}
+    for start in range(0, len(names), queries_per_request):
+        page = names[start:start + queries_per_request]
+        variables = {'accountId': account_id}
+        variables.update({name: queries[name] for name in page})
+        with telemetry.span('nerdgraph_query', queries=len(page)) as perf:
+            response = run_rate_limited(http_hook, {
+                'endpoint': '/graphql',
+                'json': {'query': build_nrql_document(page), 'variables': variables},
+                'headers': headers,
+            })
+            perf.update(bytes=len(response.content), retries=response.retries)
+
+        payload = response.json()
+        if payload.get('errors'):
+            raise Exception(f'NerdGraph returned errors: {payload["errors"]}')
+        account = payload['data']['actor']['account']
+        for name in page:
+            run_ids[name] = account[name]['results'][0]['members']
+    return run_ids
@@ -1,20 +1,61 @@
 import re
 import os
 import yaml
+from nr_utils import telemetry
+
+
+MAX_STRING_LENGTH = 4096
+# Compiled flatteners by (prefix, keys). Bounded in case records come in many different shapes
+_flatteners = {}
+_MAX_FLATTENERS = 512
+
+
+def compile_flattener(keys: tuple, prefix: str):
+    # Generates a function that flattens records with exactly these keys. The prefixed field names
+    # and the id check are worked out once here instead of for every record. Values are converted
+    # the same way flatten_dict always has: ids become strings, numbers are kept and everything
+    # else becomes a string truncated to MAX_STRING_LENGTH
+    fields = []
+    for index, key in enumerate(keys):
+        if key.endswith('_id') or key == 'id':
+            fields.append(f'{prefix + key!r}: str(record[{key!r}])')
+        else:
+            value = f'v{index}'
+            fields.append(
+                f'{prefix + key!r}: {value}[:{MAX_STRING_LENGTH}] if ({value} := record[{key!r}]).__class__ is str '
+                f'else {value} if isinstance({value}, (int, float)) else str({value})[:{MAX_STRING_LENGTH}]')
+    source = 'def flatten(record):\n    return {\n        ' + ',\n        '.join(fields) + '\n    }\n'
+    namespace = {}
+    exec(source, namespace)
+    return namespace['flatten']
+
+
+def get_flattener(keys: tuple, prefix: str):
+    flattener = _flatteners.get((prefix, keys))
+    if flattener is None:
+        if len(_flatteners) >= _MAX_FLATTENERS:
+            _flatteners.clear()
+        flattener = _flatteners[(prefix, keys)] = compile_flattener(keys, prefix)
+    return flattener
 
 
 def flatten_dict(input_dict: dict, prefix: str) -> dict:
     # Flattens one level of a dict, sets data types and adds a prefix to field names
-    max_string_length = 4096
-    flat_dict = {}
-    for key, value in input_dict.items():
-        if key.endswith('_id') or key == 'id': 
-            flat_dict[prefix + key] = str(value)
-        elif isinstance(value, int) or isinstance(value, float):
-            flat_dict[prefix + key] = value 
-        else:
-            flat_dict[prefix + key] = str(value)[0:max_string_length]
-    return flat_dict
+    return get_flattener(tuple(input_dict), prefix)(input_dict)
+
+
+def flatten_records(records: list, prefix: str = '') -> list:
+    # Flattens a list of dicts. Records with the same keys as the one before reuse its flattener
+    flat_records = []
+    last_keys = None
+    with telemetry.span('flatten', records=len(records)):
+        for record in records:
+            keys = tuple(record)
+            if keys != last_keys:
+                flatten = get_flattener(keys, prefix)
+                last_keys = keys
+            flat_records.append(flatten(record))
+    return flat_records
 
 
 def get_team_from_run(run: dict) -> str:
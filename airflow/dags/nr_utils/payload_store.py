@@ -0,0 +1,61 @@
+import gzip
+import json
+import os
+import re
+import shutil
+import uuid
+
+
+# Key that marks a dict as a reference to a stored payload
+REFERENCE_KEY = '__nr_payload_ref__'
+
+
+class PayloadStore:
+    '''Claim check store that keeps large task payloads out of XCom.
+
+    Payloads above min_bytes are written as gzipped JSON under
+    root/<dag_id>/<run_id>/ and only a small reference is returned to be pushed
+    to XCom. The root can be a local directory or a mounted object store bucket,
+    as long as every worker sees the same files.
+    '''
+
+    def __init__(self, root: str, min_bytes: int = 65536, compresslevel: int = 6):
+        self.root = root
+        self.min_bytes = min_bytes
+        self.compresslevel = compresslevel
+
+    def _run_directory(self, dag_id: str, run_id: str) -> str:
+        # Run ids contain characters like ':' and '+' that do not belong in paths
+        safe_run_id = re.sub(r'[^A-Za-z0-9_.-]', '_', run_id)
+        return os.path.join(self.root, dag_id, safe_run_id)
+
+    def offload(self, value, dag_id: str, run_id: str):
+        # Returns the value itself when it is small, otherwise a reference to the stored copy
+        serialized = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(serialized) < self.min_bytes:
+            return value
+
+        directory = self._run_directory(dag_id, run_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{uuid.uuid4().hex}.json.gz')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f_handle:
+            f_handle.write(gzip.compress(serialized, compresslevel=self.compresslevel))
+        os.replace(tmp_path, path)
+        print(f'Stored {len(serialized)} byte payload in {path}')
+        return {REFERENCE_KEY: path, 'bytes': len(serialized)}
+
+    def delete_run(self, dag_id: str, run_id: str) -> None:
+        shutil.rmtree(self._run_directory(dag_id, run_id), ignore_errors=True)
+
+
+def is_payload_reference(value) -> bool:
+    return isinstance(value, dict) and REFERENCE_KEY in value
+
+
+def load_payload(value):
+    # Reads the payload behind a reference. Any other value is returned as is
+    if not is_payload_reference(value):
+        return value
+    with gzip.open(value[REFERENCE_KEY], 'rb') as f_handle:
+        return json.loads(f_handle.read())
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Tuple
+
+log = logging.getLogger(__name__)
+
+
+async def run_fetch_upload_pipeline(items: list,
+                                    fetch: Callable[[object], Tuple[list, object]],
+                                    upload: Callable[[list], Awaitable],
+                                    max_concurrency: int = 8,
+                                    queue_size: int = 8,
+                                    uploaders: int = 2) -> list:
+    """Fetch items in worker threads and upload their events while other items are still fetching.
+
+    fetch(item) runs in a thread pool with at most max_concurrency items at once and
+    returns (events, result). Events go through a bounded queue to uploader tasks that
+    await upload(events). When uploads fall behind the queue fills up and fetching
+    pauses, so memory stays bounded.
+
+    An error for one item does not stop the others. Once every item has finished the
+    first error is raised.
+
+    Returns:
+        The result of every item, in the same order as items.
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = [None] * len(items)
+    errors = []
+    loop = asyncio.get_running_loop()
+
+    async def produce(index, item, executor):
+        async with semaphore:
+            try:
+                events, results[index] = await loop.run_in_executor(executor, fetch, item)
+            except Exception as exc:
+                log.exception('Fetching item %d failed: %s', index, exc)
+                errors.append(exc)
+                return
+            # Waiting for room in the queue keeps the semaphore held, which is what pauses fetching
+            if events:
+                await queue.put(events)
+
+    async def consume():
+        while True:
+            events = await queue.get()
+            try:
+                if events is None:
+                    return
+                await upload(events)
+            except Exception as exc:
+                log.exception('Uploading %d events failed: %s', len(events), exc)
+                errors.append(exc)
+            finally:
+                queue.task_done()
+
+    consumers = [asyncio.create_task(consume()) for _ in range(uploaders)]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        await asyncio.gather(*(produce(index, item, executor) for index, item in enumerate(items)))
+    for _ in consumers:
+        await queue.put(None)
+    await asyncio.gather(*consumers)
+
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# API families with a request budget each
+ADMIN_API = 'admin'
+DISCOVERY_API = 'discovery'
+NERDGRAPH = 'nerdgraph'
+EVENT_API = 'event_api'
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+def get_retry_after(headers) -> Optional[float]:
+    # Retry-After can be a number of seconds or an HTTP date
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _header_number(headers, name: str) -> Optional[float]:
+    value = headers.get(name) if headers else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+    '''Token bucket for one API family, shared by every thread and coroutine in the process.
+
+    Callers take a token before each request and wait when the bucket is
+    empty, so concurrent calls stay within requests_per_second with bursts of
+    up to burst requests. A Retry-After on a 429 or 503 response pauses every
+    caller of the family, and X-RateLimit-Remaining and X-RateLimit-Reset slow
+    the bucket down to the budget the server reports until it resets. Without
+    requests_per_second only the response headers limit the rate.
+    '''
+
+    def __init__(self, name: str, requests_per_second: Optional[float] = None, burst: Optional[float] = None):
+        self.name = name
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._header_rate = None
+        self._header_rate_until = 0.0
+        self.requests_per_second = None
+        self.configure(requests_per_second, burst)
+
+    def configure(self, requests_per_second: Optional[float] = None, burst: Optional[float] = None) -> None:
+        with self._lock:
+            burst = burst or max(requests_per_second or 1, 1)
+            # A limiter that was not limited yet starts with a full bucket
+            if not self.requests_per_second:
+                self._tokens = burst
+            self.requests_per_second = requests_per_second
+            self.burst = burst
+
+    def _rate(self, now: float) -> Optional[float]:
+        rate = self.requests_per_second
+        if self._header_rate is not None and now < self._header_rate_until:
+            rate = min(rate, self._header_rate) if rate else self._header_rate
+        return rate
+
+    def reserve(self) -> float:
+        # Takes a token and returns how many seconds to wait before sending the request
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._paused_until - now, 0)
+            rate = self._rate(now)
+            if rate:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * rate)
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / rate)
+            self._updated = now
+            return wait
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        # Holds back every caller of the family, for instance for the Retry-After of a 429
+        with self._lock:
+            paused_until = time.monotonic() + seconds
+            if paused_until > self._paused_until:
+                self._paused_until = paused_until
+                log.warning('Pausing %s requests for %.1fs', self.name, seconds)
+
+    def observe(self, status: Optional[int], headers) -> Optional[float]:
+        # Adapts to the rate limit headers of a response. Returns the Retry-After in seconds, if any
+        retry_after = get_retry_after(headers)
+        if status in (429, 503) and retry_after is not None:
+            self.pause(retry_after)
+
+        remaining = _header_number(headers, 'X-RateLimit-Remaining')
+        reset = _header_number(headers, 'X-RateLimit-Reset')
+        if remaining is None or not reset:
+            return retry_after
+        # Reset is either seconds until the window resets or the epoch time it resets at
+        reset_seconds = reset - time.time() if reset > 1_000_000_000 else reset
+        if reset_seconds <= 0:
+            return retry_after
+        if remaining < 1:
+            self.pause(reset_seconds)
+        else:
+            with self._lock:
+                self._header_rate = remaining / reset_seconds
+                self._header_rate_until = time.monotonic() + reset_seconds
+        return retry_after
+
+
+def get_limiter(family: str) -> RateLimiter:
+    # The limiter of an API family. Families without configured limits only follow the response headers
+    with _lock:
+        limiter = _limiters.get(family)
+        if limiter is None:
+            limiter = _limiters[family] = RateLimiter(family)
+        return limiter
+
+
+def configure(limits: dict) -> None:
+    '''Sets the budget of each API family.
+
+    limits maps a family (admin, discovery, nerdgraph or event_api) to a dict
+    with requests_per_second and burst. Limiters keep their state, so calling
+    this at the start of every task does not reset pauses.
+    '''
+    for family, settings in (limits or {}).items():
+        settings = settings or {}
+        get_limiter(family).configure(settings.get('requests_per_second'), settings.get('burst'))
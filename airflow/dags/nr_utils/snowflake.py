@@ -1,53 +1,240 @@
 import uuid
-from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
-from nr_utils.nr_utils import flatten_dict
+from collections import deque
+from nr_utils.nr_utils import MAX_STRING_LENGTH, flatten_dict
+from nr_utils import telemetry
 import time
-import os 
+import os
 
 
-def get_failed_test_rows(failed_tests: list, snowflake_conn_id: str, max_retries: int = 3, retry_delay: int = 10) -> list:
-    # Queries Snowflake with a failed test query
-    hook = SnowflakeHook(snowflake_conn_id=snowflake_conn_id)
+# Only the first columns of a failed test query are sent, one field_N attribute each
+MAX_FAILED_TEST_ROW_COLUMNS = 10
+
+
+def limit_test_sql(sql: str, limit: int) -> str:
+    # Wraps a failed test query so Snowflake stops after limit rows instead of computing every failing row.
+    # The closing parenthesis is on its own line in case the query ends with a line comment
+    sql = sql.strip().rstrip(';').rstrip()
+    return f'select * from (\n{sql}\n) limit {int(limit)}'
+
+
+def get_failed_test_row_events_from_columns(test: dict, columns: list, column_values: list) -> list:
+    # Builds dbt_failed_test_row events from the values of each of the first columns. The test attributes
+    # are flattened once and shared by every row instead of being copied and flattened for each row
+    test_fields = dict(test)
+    test_fields['eventType'] = 'dbt_failed_test_row'
+    test_fields['entity_name'] = f'{test["alias"]} - {test["run_created_at"]}'
+    test_fields = flatten_dict(test_fields, '')
+
+    field_columns = [
+        [f'{column}: {value}'[:MAX_STRING_LENGTH] for value in values]
+        for column, values in zip(columns[:MAX_FAILED_TEST_ROW_COLUMNS], column_values)
+    ]
+    field_names = [f'field_{index + 1}' for index in range(len(field_columns))]
     failed_test_rows = []
-    for test in failed_tests:
-        attempt = 0
-        success = False
-        while attempt < max_retries and not success:
+    for fields in zip(*field_columns):
+        failed_row = dict(zip(field_names, fields))
+        failed_row.update(test_fields)
+        failed_row['entity_id'] = f'{uuid.uuid4()}'
+        failed_test_rows.append(failed_row)
+    return failed_test_rows
+
+
+def get_failed_test_error_row(test: dict, e: Exception) -> dict:
+    # Too many things can prevent the query from running. We do not
+    # want to fail the job for failed test rows.
+    error_row = test.copy()
+    error_row['field_1'] = 'test_sql_error = ' + str(e)
+    error_row['eventType'] = 'dbt_failed_test_row'
+    return flatten_dict(error_row, '')
+
+
+def is_connection_error(conn, e: Exception) -> bool:
+    # Errors that leave the connection unusable, as opposed to errors of a single query. Per the DB-API,
+    # the Snowflake connector raises OperationalError and InterfaceError for network and session problems
+    if conn is not None and getattr(conn, 'is_closed', None) and conn.is_closed():
+        return True
+    try:
+        from snowflake.connector.errors import InterfaceError, OperationalError
+    except ImportError:
+        return False
+    return isinstance(e, (InterfaceError, OperationalError))
+
+
+def close_quietly(conn) -> None:
+    if conn is None:
+        return
+    try:
+        conn.close()
+    except Exception as e:
+        print(f'Error closing the Snowflake connection: {str(e)}')
+
+
+def fetch_failed_test_columns(cursor, limit: int, arrow: bool = True) -> tuple:
+    # Reads at most limit rows of a finished query. Returns the column names and the values of the first
+    # columns. Results are read as Arrow batches when pyarrow is installed, so values are converted a column
+    # at a time instead of a row at a time. Falls back to fetchmany when Arrow results are not available.
+    columns = [column[0] for column in cursor.description]
+    if arrow:
+        try:
+            import pyarrow
+        except ImportError:
+            pyarrow = None
+        if pyarrow is not None and hasattr(cursor, 'fetch_arrow_batches'):
+            try:
+                tables = []
+                row_count = 0
+                for table in cursor.fetch_arrow_batches():
+                    tables.append(table)
+                    row_count += table.num_rows
+                    if row_count >= limit:
+                        break
+            except Exception as e:
+                print(f'Could not fetch Arrow results, fetching rows instead. Exception: {e}')
+            else:
+                if not tables:
+                    return columns, []
+                table = pyarrow.concat_tables(tables).slice(0, limit)
+                return columns, [table.column(index).to_pylist()
+                                 for index in range(min(table.num_columns, MAX_FAILED_TEST_ROW_COLUMNS))]
+    rows = cursor.fetchmany(limit)
+    return columns, list(zip(*rows))[:MAX_FAILED_TEST_ROW_COLUMNS]
+
+
+def get_failed_test_rows(failed_tests: list,
+                         snowflake_conn_id: str,
+                         max_retries: int = 3,
+                         retry_delay: int = 10,
+                         max_concurrent_queries: int = 8,
+                         poll_interval: float = 1,
+                         push_down_limit: bool = True,
+                         query_timeout_seconds: int = None,
+                         arrow: bool = True) -> list:
+    # Queries Snowflake with a failed test query. Queries are submitted asynchronously on a single
+    # connection so Snowflake runs them at the same time. A query that fails is resubmitted after
+    # retry_delay without holding up the queries of the other tests. With push_down_limit, each query
+    # is wrapped in a limit of failed_test_row_limit rows. query_timeout_seconds is set as the statement
+    # timeout of the session, so Snowflake cancels queries that run longer. Connecting is retried the
+    # same way, and when the connection drops a new one is opened and the running queries are submitted
+    # again. If Snowflake can not be reached, every remaining test gets an error row.
+    if not failed_tests:
+        return []
+
+    # Imported here so parsing the DAG does not load the Snowflake provider
+    from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
+
+    hook = SnowflakeHook(snowflake_conn_id=snowflake_conn_id)
+
+    def connect():
+        # Using the conn directly to avoid logging each row
+        for attempt in range(1, max_retries + 1):
+            conn = None
             try:
-                # Using the conn directly to avoid logging each row 
                 conn = hook.get_conn()
-                sql = test['compiled_sql']
-                failed_test_row_num = test['failed_test_row_limit']
-                print(f'Running sql for failed test {test["unique_id"]}: {sql}')
-                cursor = conn.cursor()
-                cursor.execute(sql)
-                columns = [column[0] for column in cursor.description]
-                results = cursor.fetchmany(failed_test_row_num)
-                cursor.close()
-                conn.close()
-                for row in results:
-                    failed_row = {}
-                    # Create one attribute for each of the first 10 returned columns
-                    for index, column in enumerate(columns[0:10]):
-                        failed_row[f'field_{index + 1}'] = f'{column}: {row[index]}'
-                    failed_row.update(test)
-                    failed_row['eventType'] = 'dbt_failed_test_row'
-                    failed_row['entity_id'] = f'{uuid.uuid4()}'
-                    failed_row['entity_name'] = f'{test["alias"]} - {test["run_created_at"]}'
-                    failed_test_rows.append(flatten_dict(failed_row, ''))
-                success = True
+                if query_timeout_seconds:
+                    cursor = conn.cursor()
+                    cursor.execute(f'alter session set STATEMENT_TIMEOUT_IN_SECONDS = {int(query_timeout_seconds)}')
+                    cursor.close()
+                return conn, None
             except Exception as e:
-                attempt += 1
-                print(f"Error fetching failed test row on attempt {attempt}/{max_retries}: {str(e)}")
-                if attempt < max_retries:
-                    print(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                else:
+                print(f'Error connecting to Snowflake on attempt {attempt}/{max_retries}: {str(e)}')
+                close_quietly(conn)
+                if attempt == max_retries:
                     print("Max retries reached")
-                    # Too many things can prevent the query from running. We do not
-                    # want to fail the job for failed test rows. 
-                    test['field_1'] = 'test_sql_error = ' + str(e)
-                    test['eventType'] = 'dbt_failed_test_row'
-                    return [flatten_dict(test, '')]
-    
-    return failed_test_rows
\ No newline at end of file
+                    return None, e
+                print(f"Retrying in {retry_delay} seconds...")
+                time.sleep(retry_delay)
+
+    failed_test_rows = []
+    conn, connect_error = connect()
+    if conn is None:
+        return [get_failed_test_error_row(test, connect_error) for test in failed_tests]
+    # Tests waiting to be submitted as (test, attempt, earliest submit time)
+    pending = deque((test, 1, 0) for test in failed_tests)
+    # Submitted queries as query id: (test, attempt, submit time)
+    running = {}
+
+    def record_query(test, attempt, submitted_at, status, rows=0, error=None):
+        telemetry.record_span('snowflake_query', submitted_at, time.time() - submitted_at,
+                              unique_id=test['unique_id'], run_id=test.get('run_id'), status=status,
+                              records=rows, retries=attempt - 1, error=error)
+
+    def handle_error(test, attempt, e):
+        print(f"Error fetching failed test row for {test['unique_id']} on attempt {attempt}/{max_retries}: {str(e)}")
+        if attempt < max_retries:
+            print(f"Retrying in {retry_delay} seconds...")
+            pending.append((test, attempt + 1, time.monotonic() + retry_delay))
+        else:
+            print("Max retries reached")
+            failed_test_rows.append(get_failed_test_error_row(test, e))
+
+    try:
+        while pending or running:
+            connection_lost = False
+            # Submit every test that is due while there is room
+            for _ in range(len(pending)):
+                if len(running) >= max_concurrent_queries:
+                    break
+                test, attempt, not_before = pending.popleft()
+                if not_before > time.monotonic():
+                    pending.append((test, attempt, not_before))
+                    continue
+                submitted_at = time.time()
+                try:
+                    sql = test['compiled_sql']
+                    if push_down_limit:
+                        sql = limit_test_sql(sql, test['failed_test_row_limit'])
+                    print(f'Running sql for failed test {test["unique_id"]}: {sql}')
+                    cursor = conn.cursor()
+                    cursor.execute_async(sql)
+                    running[cursor.sfqid] = (test, attempt, submitted_at)
+                    cursor.close()
+                except Exception as e:
+                    record_query(test, attempt, submitted_at, 'error', error=str(e)[:1000])
+                    handle_error(test, attempt, e)
+                    if is_connection_error(conn, e):
+                        connection_lost = True
+                        break
+
+            # Collect results of the queries that finished
+            for query_id, (test, attempt, submitted_at) in list(running.items()):
+                if connection_lost:
+                    break
+                try:
+                    status = conn.get_query_status_throw_if_error(query_id)
+                    if conn.is_still_running(status):
+                        continue
+                    del running[query_id]
+                    cursor = conn.cursor()
+                    cursor.get_results_from_sfqid(query_id)
+                    columns, column_values = fetch_failed_test_columns(cursor, test['failed_test_row_limit'], arrow)
+                    cursor.close()
+                    row_count = len(column_values[0]) if column_values else 0
+                    record_query(test, attempt, submitted_at, 'success', rows=row_count)
+                    failed_test_rows += get_failed_test_row_events_from_columns(test, columns, column_values)
+                except Exception as e:
+                    running.pop(query_id, None)
+                    record_query(test, attempt, submitted_at, 'error', error=str(e)[:1000])
+                    handle_error(test, attempt, e)
+                    if is_connection_error(conn, e):
+                        connection_lost = True
+
+            if connection_lost:
+                # Queries of the lost session are submitted again on a new connection instead of being
+                # retried against the dead one. They keep their attempt since the query itself did not fail
+                print('Lost the Snowflake connection, reconnecting')
+                close_quietly(conn)
+                pending.extend((test, attempt, 0) for test, attempt, _submitted_at in running.values())
+                running.clear()
+                conn, connect_error = connect()
+                if conn is None:
+                    failed_test_rows += [get_failed_test_error_row(test, connect_error) for test, _attempt, _not_before in pending]
+                    pending.clear()
+                continue
+
+            if pending or running:
+                time.sleep(poll_interval)
+    finally:
+        close_quietly(conn)
+
+    return failed_test_rows
+
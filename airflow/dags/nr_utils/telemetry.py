@@ -0,0 +1,92 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+# Event type of the spans sent to New Relic
+EVENT_TYPE = 'dbt_integration_perf'
+# Spans kept in memory between two drains. Older spans are dropped first
+MAX_SPANS = 10000
+
+_lock = threading.Lock()
+_spans = []
+_dropped = 0
+_enabled = True
+
+
+def enable(enabled: bool = True) -> None:
+    # Spans are not recorded while telemetry is disabled
+    global _enabled
+    _enabled = enabled
+
+
+def record_span(stage: str, started_at: float, duration: float, **attributes) -> None:
+    '''Records a timing span for a stage of the pipeline.
+
+    started_at is a time.time() timestamp and duration is in seconds. Attributes
+    should be scalars, for instance bytes, records and retries. Safe to call from
+    any thread or coroutine.
+    '''
+    global _dropped
+    if not _enabled:
+        return
+    span = {
+        'stage': stage,
+        'timestamp': int(started_at * 1000),
+        'duration_seconds': duration,
+    }
+    span.update(attributes)
+    with _lock:
+        if len(_spans) >= MAX_SPANS:
+            del _spans[0]
+            _dropped += 1
+        _spans.append(span)
+
+
+@contextmanager
+def span(stage: str, **attributes) -> Iterator[dict]:
+    '''Times the body of a with block as a span.
+
+    Yields the dict of span attributes so the body can add counts as it goes.
+    status is set to 'error' with the error message when the body raises.
+    '''
+    started_at = time.time()
+    start = time.monotonic()
+    attributes.setdefault('status', 'success')
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes['status'] = 'error'
+        attributes['error'] = str(e)[:1000]
+        raise
+    finally:
+        record_span(stage, started_at, time.monotonic() - start, **attributes)
+
+
+def drain_spans() -> list:
+    # Returns and forgets every span recorded so far
+    global _dropped
+    with _lock:
+        spans = _spans[:]
+        _spans.clear()
+        dropped = _dropped
+        _dropped = 0
+    if dropped:
+        print(f'Dropped {dropped} telemetry spans')
+    return spans
+
+
+def build_events(spans: list, **context) -> list:
+    # Turns spans into dbt_integration_perf events. context is added to every event, for instance the dag_id
+    events = []
+    for span in spans:
+        event = {'eventType': EVENT_TYPE}
+        event.update(context)
+        for key, value in span.items():
+            if value is None:
+                continue
+            # The Event API only takes numbers and strings
+            event[key] = value if isinstance(value, (int, float, str)) else str(value)
+        events.append(event)
+    return events
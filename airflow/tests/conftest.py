@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The DAG folder is on sys.path in Airflow, so nr_utils is imported the same way here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
@@ -0,0 +1,94 @@
+import os
+import re
+
+import pytest
+import yaml
+
+from nr_utils.dbt_cloud import build_dbt_discovery_detail_document, build_dbt_discovery_document, split_discovery_queries
+
+
+QUERIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags', 'dbt_cloud_run_metadata',
+                            'dbt_discovery_queries.yml')
+# "alias: fieldName" or a bare field name
+_SELECTION_PATTERN = re.compile(r'(\w+)(?:\s*:\s*(\w+))?')
+
+
+def load_queries() -> list:
+    with open(QUERIES_FILE) as f_handle:
+        return yaml.safe_load(f_handle)
+
+
+def parse_selections(text: str) -> list:
+    # Returns (alias, field) pairs of a flat selection set. A bare field is its own alias
+    return [(alias, field or alias) for alias, field in _SELECTION_PATTERN.findall(text)]
+
+
+def split_query(query: str) -> tuple:
+    # Splits "field(arguments) { selections }" into the part before the braces and the selections
+    assert query.count('{') == 1 and query.count('}') == 1, query
+    head, body = query.split('{')
+    return head.strip(), parse_selections(body.split('}')[0])
+
+
+def assert_balanced(document: str) -> None:
+    depth = 0
+    for char in document:
+        depth += {'{': 1, '}': -1}.get(char, 0)
+        assert depth >= 0, document
+    assert depth == 0, document
+
+
+QUERIES = load_queries()
+
+
+@pytest.mark.parametrize('query', QUERIES, ids=[query['resource_type'] for query in QUERIES])
+def test_light_query_keeps_only_light_fields(query):
+    light_queries, _detail_queries = split_discovery_queries([query])
+    heavy_fields = set(query['heavy_fields'])
+    head, selections = split_query(query['query'])
+    light_head, light_selections = split_query(light_queries[0]['query'])
+
+    assert light_head == head
+    assert light_selections == [(alias, field) for alias, field in selections if alias not in heavy_fields]
+    # Neither side of a heavy alias is left behind
+    heavy_names = {name for alias, field in selections if alias in heavy_fields for name in (alias, field)}
+    assert not heavy_names & {name for selection in light_selections for name in selection}
+    assert {'name', 'unique_id', 'status'} <= {alias for alias, _field in light_selections}
+
+
+@pytest.mark.parametrize('query', QUERIES, ids=[query['resource_type'] for query in QUERIES])
+def test_detail_selection_holds_the_heavy_fields(query):
+    _light_queries, detail_queries = split_discovery_queries([query])
+    _head, selections = split_query(query['query'])
+    detail_query = detail_queries[query['resource_type']]
+
+    assert detail_query['single_resource'] == query['single_resource']
+    assert parse_selections(detail_query['selection']) == [(alias, field) for alias, field in selections
+                                                           if alias in query['heavy_fields']]
+
+
+def test_detail_document_is_well_formed():
+    _light_queries, detail_queries = split_discovery_queries(QUERIES)
+    resources = [('models', 'model.analytics.orders'), ('tests', 'test.analytics.not_null'), ('seeds', 'seed.analytics.c')]
+    document = build_dbt_discovery_detail_document(resources, detail_queries)
+
+    assert_balanced(document)
+    assert 'query dbtResourceDetails($jobId: Int!, $runId: Int, $u0: String!, $u1: String!, $u2: String!)' in document
+    assert 'u0: model(jobId: $jobId, runId: $runId, uniqueId: $u0) { unique_id: uniqueId ' in document
+    assert 'u1: test(jobId: $jobId, runId: $runId, uniqueId: $u1)' in document
+    assert 'u2: seed(jobId: $jobId, runId: $runId, uniqueId: $u2) { unique_id: uniqueId compiled_sql: compiledSql }' in document
+
+
+def test_light_document_is_well_formed():
+    light_queries, _detail_queries = split_discovery_queries(QUERIES)
+    document = build_dbt_discovery_document(light_queries, run_count=2)
+
+    assert_balanced(document)
+    for name in ('rawSql', 'rawCode', 'compiledSql', 'compiledCode'):
+        assert name not in document
+    assert 'r1_models: models(jobId: $jobId_1, runId: $runId_1)' in document
+
+
+def test_queries_without_heavy_fields_are_unchanged():
+    query = {'resource_type': 'sources', 'query': 'sources(jobId: $jobId, runId: $runId) { name raw_sql: rawSql }'}
+    assert split_discovery_queries([query]) == ([query], {})
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from decimal import Decimal
+
+import pytest
+
+from nr_utils.nr_utils import MAX_STRING_LENGTH, flatten_dict, flatten_records
+
+
+def flatten_dict_loop(input_dict: dict, prefix: str) -> dict:
+    # The implementation flatten_dict had before it was compiled per record shape
+    flat_dict = {}
+    for key, value in input_dict.items():
+        if key.endswith('_id') or key == 'id':
+            flat_dict[prefix + key] = str(value)
+        elif isinstance(value, int) or isinstance(value, float):
+            flat_dict[prefix + key] = value
+        else:
+            flat_dict[prefix + key] = str(value)[0:MAX_STRING_LENGTH]
+    return flat_dict
+
+
+class Label(str):
+    pass
+
+
+RECORDS = [
+    {
+        'id': 7,
+        'run_id': 1000,
+        'job_id': '42',
+        'definition_id': None,
+        'execution_time': 1.25,
+        'run_status': 10,
+        'skip': False,
+        'alert_failed_test_rows': True,
+        'error': None,
+        'name': 'orders',
+        'compiled_sql': 'select 1 ' * 1000,
+        'description': 'x' * MAX_STRING_LENGTH,
+        'exact': 'y' * (MAX_STRING_LENGTH + 1),
+        'meta': {'owner': 'data', 'nested': {'tier': 1}},
+        'tags': ['daily', 'finance'],
+        'depends_on': {'nodes': ['model.a', 'model.b']},
+        'amount': Decimal('1.50'),
+        'label': Label('subclass of str'),
+        'empty': '',
+        'unicode': 'café ☃',
+    },
+    {
+        "it's": 'single quote',
+        'say "hi"': 'double quote',
+        'back\\slash': 'backslash',
+        'new\nline': 'newline',
+        "'''": 'triple quotes',
+        '"+str(1)+"': 'code like key',
+        'ends_with_id': 3.5,
+        'idx': 4,
+    },
+    {},
+]
+
+
+@pytest.mark.parametrize('prefix', ['', 'run_', "p'\\"])
+@pytest.mark.parametrize('record', RECORDS)
+def test_flatten_dict_matches_loop(record, prefix):
+    flat = flatten_dict(record, prefix)
+    expected = flatten_dict_loop(record, prefix)
+    assert flat == expected
+    assert list(flat) == list(expected)
+    assert [type(value) for value in flat.values()] == [type(value) for value in expected.values()]
+
+
+def test_flatten_records_matches_loop_across_shapes():
+    # Alternating shapes make flatten_records switch flatteners between records
+    records = [RECORDS[index % 2] for index in range(6)] + [dict(reversed(list(RECORDS[0].items())))]
+    assert flatten_records(records) == [flatten_dict_loop(record, '') for record in records]
+    assert flatten_records(records, 'run_') == [flatten_dict_loop(record, 'run_') for record in records]
+
+
+def test_values_of_the_same_shape_are_not_cached():
+    first = flatten_dict({'name': 'a', 'run_id': 1}, '')
+    second = flatten_dict(OrderedDict([('name', 'b'), ('run_id', 2)]), '')
+    assert first == {'name': 'a', 'run_id': '1'}
+    assert second == {'name': 'b', 'run_id': '2'}
+
+
+def test_long_strings_are_truncated():
+    flat = flatten_dict({'text': 'z' * (MAX_STRING_LENGTH * 2), 'nested': {'text': 'z' * MAX_STRING_LENGTH}}, '')
+    assert len(flat['text']) == MAX_STRING_LENGTH
+    assert len(flat['nested']) == MAX_STRING_LENGTH
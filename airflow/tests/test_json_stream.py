@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from nr_utils.json_stream import JsonStreamReader, iter_json_object_items
+
+
+MANIFEST = json.dumps({
+    'metadata': {'dbt_version': '1.8.0', 'generated_at': '2024-06-10T06:13:20Z'},
+    'nodes': {
+        'model.analytics.orders': {'name': 'orders', 'created_at': 1718000000.5, 'tags': ['daily'], 'config': {}},
+        'model.analytics.customers': {'name': 'customers', 'created_at': 1.718e+09, 'depends_on': {'nodes': []}},
+        'test.analytics.not_null': {'name': 'not_null', 'created_at': -12.25E-3, 'enabled': True, 'meta': None},
+        'seed.analytics.countries': {'name': 'countries', 'created_at': 1718000000, 'rows': [1, 2.5, -3]},
+    },
+    'macros': {'macro.analytics.m': {'created_at': 1718000000.5}},
+}, indent=1)
+
+
+def split_at(text: str, position: int, as_bytes: bool = False) -> list:
+    chunks = [text[:position], text[position:]]
+    return [chunk.encode() for chunk in chunks] if as_bytes else chunks
+
+
+@pytest.mark.parametrize('as_bytes', [False, True])
+def test_every_two_chunk_split_yields_all_nodes(as_bytes):
+    expected = list(json.loads(MANIFEST)['nodes'].items())
+    for position in range(len(MANIFEST) + 1):
+        chunks = split_at(MANIFEST, position, as_bytes)
+        assert list(iter_json_object_items(chunks, 'nodes')) == expected, position
+
+
+def test_every_two_chunk_split_with_skipped_nodes():
+    unique_ids = {'model.analytics.customers', 'seed.analytics.countries'}
+    expected = [(key, value) for key, value in json.loads(MANIFEST)['nodes'].items() if key in unique_ids]
+    for position in range(len(MANIFEST) + 1):
+        chunks = split_at(MANIFEST, position)
+        assert list(iter_json_object_items(chunks, 'nodes', unique_ids)) == expected, position
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7])
+def test_small_chunks(chunk_size):
+    chunks = [MANIFEST[start:start + chunk_size] for start in range(0, len(MANIFEST), chunk_size)]
+    assert dict(iter_json_object_items(chunks, 'nodes')) == json.loads(MANIFEST)['nodes']
+
+
+def test_number_split_after_decimal_point():
+    chunks = ['{"macros": {"m": {"created_at": 1718000000.', '5}}}']
+    assert list(iter_json_object_items(chunks, 'macros')) == [('m', {'created_at': 1718000000.5})]
+
+
+def test_multibyte_character_split_across_chunks():
+    document = json.dumps({'nodes': {'a': {'description': 'café ☃'}}}, ensure_ascii=False).encode()
+    for position in range(len(document) + 1):
+        chunks = [document[:position], document[position:]]
+        assert list(iter_json_object_items(chunks, 'nodes')) == [('a', {'description': 'café ☃'})], position
+
+
+def test_top_level_scalar_at_end_of_stream():
+    assert JsonStreamReader(['12', '.5']).read_value() == 12.5
+
+
+def test_truncated_document_raises():
+    with pytest.raises(ValueError):
+        list(iter_json_object_items([MANIFEST[:len(MANIFEST) // 2]], 'nodes'))